@@ -1,5 +1,7 @@
 from django.contrib import admin
+from django.db import transaction as db_transaction
 from .models import Student, Transaction, UserProfile
+from . import ledger
 
 @admin.register(UserProfile)
 class UserProfileAdmin(admin.ModelAdmin):
@@ -13,9 +15,46 @@ class StudentAdmin(admin.ModelAdmin):
     list_display = ('name', 'teacher', 'balance', 'is_hidden')
     list_filter = ('teacher', 'is_hidden')
     search_fields = ('name',)
+    actions = ('award_one_coin', 'award_two_coins', 'award_three_coins')
+
+    def _award(self, request, queryset, amount):
+        results = ledger.award_coins(queryset, amount, request.user, comment='Начислено через админку')
+        self.message_user(request, f'Awarded {amount} IQ-coins to {len(results)} students.')
+
+    @admin.action(description='Наградить: 1 Айкьюшка')
+    def award_one_coin(self, request, queryset):
+        self._award(request, queryset, 1)
+
+    @admin.action(description='Наградить: 2 Айкьюшки')
+    def award_two_coins(self, request, queryset):
+        self._award(request, queryset, 2)
+
+    @admin.action(description='Наградить: 3 Айкьюшки')
+    def award_three_coins(self, request, queryset):
+        self._award(request, queryset, 3)
 
 @admin.register(Transaction)
 class TransactionAdmin(admin.ModelAdmin):
     list_display = ('type', 'amount', 'student', 'teacher', 'date', 'edited')
     list_filter = ('type', 'student', 'teacher', 'date')
-    search_fields = ('student__name', 'teacher__username')
\ No newline at end of file
+    search_fields = ('student__name', 'teacher__username')
+
+    # The ledger keeps the daily rollup and the coins earned up to date as it
+    # writes; changes made here bypass it, so they are counted here instead
+    def save_model(self, request, obj, form, change):
+        with db_transaction.atomic():
+            if change:
+                old = Transaction.objects.select_related('student').get(pk=obj.pk)
+                ledger.count_transactions([old], sign=-1)
+            super().save_model(request, obj, form, change)
+            ledger.count_transactions([obj])
+
+    def delete_model(self, request, obj):
+        with db_transaction.atomic():
+            ledger.count_transactions([obj], sign=-1)
+            super().delete_model(request, obj)
+
+    def delete_queryset(self, request, queryset):
+        with db_transaction.atomic():
+            ledger.count_transactions(queryset.select_related('student'), sign=-1)
+            super().delete_queryset(request, queryset)
\ No newline at end of file
@@ -0,0 +1,131 @@
+from collections import defaultdict
+from django.db import transaction as db_transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDate, TruncWeek
+from django.utils import timezone
+from .models import Transaction, TransactionDailyRollup
+from .teacher_names import teacher_display_name
+
+
+def _add(changes):
+    """
+    Add (count, amount) deltas to rollup rows.
+
+    `changes` maps (day, teacher id, student id, type) -> (count, amount).
+    Rows are created when missing, then rows sharing the same deltas are
+    updated with one query, so a bulk award costs two queries.
+    """
+    if not changes:
+        return
+    TransactionDailyRollup.objects.bulk_create(
+        [
+            TransactionDailyRollup(day=day, teacher_id=teacher_id, student_id=student_id, type=trans_type)
+            for day, teacher_id, student_id, trans_type in changes
+        ],
+        ignore_conflicts=True,
+    )
+    groups = defaultdict(list)
+    for (day, teacher_id, student_id, trans_type), delta in changes.items():
+        groups[(day, teacher_id, trans_type) + delta].append(student_id)
+    for (day, teacher_id, trans_type, count, amount), student_ids in groups.items():
+        TransactionDailyRollup.objects.filter(
+            day=day, teacher_id=teacher_id, type=trans_type, student_id__in=student_ids
+        ).update(count=F('count') + count, amount=F('amount') + amount)
+
+
+def record_transactions(transactions, sign=1):
+    """Count newly written transactions in the daily rollup (sign=-1 takes them out again)"""
+    changes = defaultdict(lambda: (0, 0))
+    for trans in transactions:
+        key = (timezone.localdate(trans.date), trans.teacher_id, trans.student_id, trans.type)
+        count, amount = changes[key]
+        changes[key] = (count + sign, amount + sign * trans.amount)
+    _add(changes)
+
+
+def record_amount_change(trans, difference):
+    """Move the rollup of an edited transaction by the change in its amount"""
+    if difference:
+        key = (timezone.localdate(trans.date), trans.teacher_id, trans.student_id, trans.type)
+        _add({key: (0, difference)})
+
+
+def rebuild_rollups(batch_size=1000):
+    """
+    Recompute the whole daily rollup from the transaction ledger.
+    Returns the number of rows written.
+    """
+    written = 0
+    with db_transaction.atomic():
+        TransactionDailyRollup.objects.all().delete()
+        rows = (
+            Transaction.objects.annotate(day=TruncDate('date'))
+            .values_list('day', 'teacher_id', 'student_id', 'type')
+            .annotate(total=Sum('amount'), number=Count('id'))
+            .order_by()
+        )
+        batch = []
+        for day, teacher_id, student_id, trans_type, total, number in rows.iterator():
+            batch.append(TransactionDailyRollup(
+                day=day,
+                teacher_id=teacher_id,
+                student_id=student_id,
+                type=trans_type,
+                count=number,
+                amount=total,
+            ))
+            if len(batch) >= batch_size:
+                TransactionDailyRollup.objects.bulk_create(batch)
+                written += len(batch)
+                batch = []
+        TransactionDailyRollup.objects.bulk_create(batch)
+        written += len(batch)
+    return written
+
+
+def _pivot(rows, key):
+    """Fold (key, type, count, amount) rows into one dict per key with award/deduct columns"""
+    result = {}
+    for row in rows:
+        entry = result.setdefault(row[key], {
+            'award_count': 0, 'award_amount': 0, 'deduct_count': 0, 'deduct_amount': 0,
+        })
+        prefix = 'award' if row['type'] == 'AWARD' else 'deduct'
+        entry[f'{prefix}_count'] += row['count']
+        entry[f'{prefix}_amount'] += row['amount']
+    return result
+
+
+def summary(start, end):
+    """
+    Totals per type, per teacher and per week for the days start..end,
+    read only from the rollup.
+    """
+    rollups = TransactionDailyRollup.objects.filter(day__range=(start, end))
+
+    teachers = _pivot(
+        rollups.values('teacher_id', 'type').annotate(count=Sum('count'), amount=Sum('amount')).order_by(),
+        'teacher_id',
+    )
+    # Overall totals per type are the sum over teachers
+    totals = {'award_count': 0, 'award_amount': 0, 'deduct_count': 0, 'deduct_amount': 0}
+    for entry in teachers.values():
+        for column in totals:
+            totals[column] += entry[column]
+    by_teacher = sorted(
+        ({'teacher_name': teacher_display_name(teacher_id), **entry} for teacher_id, entry in teachers.items()),
+        key=lambda entry: entry['teacher_name'],
+    )
+
+    weeks = _pivot(
+        rollups.annotate(week=TruncWeek('day'))
+        .values('week', 'type').annotate(count=Sum('count'), amount=Sum('amount')).order_by(),
+        'week',
+    )
+    by_week = [{'week': week, **entry} for week, entry in sorted(weeks.items())]
+
+    return {
+        'totals': totals,
+        'by_teacher': by_teacher,
+        'by_week': by_week,
+    }
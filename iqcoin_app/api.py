@@ -0,0 +1,163 @@
+import hashlib
+from functools import wraps
+from time import time
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction as db_transaction
+from django.http import JsonResponse
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers, quote_etag
+from django.utils.http import http_date
+from .models import Student, Transaction
+from .pagination import keyset_page
+from .queries import filtered_transactions
+
+# Cache key holding the time existing rows last changed (edited transactions,
+# student edits, imports); new transactions move the validators by themselves
+API_VERSION_KEY = 'iqcoin:api_version'
+
+
+def _bump_api_version():
+    cache.set(API_VERSION_KEY, time(), None)
+
+
+def _api_version():
+    version = cache.get(API_VERSION_KEY)
+    if version is None:
+        # Lost from the cache: anything may have changed since
+        version = time()
+        cache.set(API_VERSION_KEY, version, None)
+    return version
+
+
+def invalidate_api_etags():
+    """Make every ETag handed out so far stale, once the current transaction commits"""
+    db_transaction.on_commit(_bump_api_version)
+
+
+def _api_login_required(view_func):
+    """Like login_required, but answers 401 JSON instead of redirecting to the login page"""
+    @wraps(view_func)
+    def _wrapped_view(request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return JsonResponse({'error': 'Authentication required'}, status=401)
+        return view_func(request, *args, **kwargs)
+    return _wrapped_view
+
+
+def _conditional_json(request, transactions, build):
+    """
+    Answer with build()'s data as JSON, or with 304 Not Modified when the
+    client's copy is current.
+
+    The validators come from the newest of `transactions` (one index seek)
+    and the time existing rows last changed, so an unchanged poll costs one
+    query and nothing is serialised.
+    """
+    newest = transactions.order_by('-date', '-id').values_list('id', 'date').first()
+    newest_id, newest_date = newest or (0, None)
+    version = _api_version()
+    # Responses differ per user and query string, so both are part of the tag
+    key = f"{request.user.id}|{request.iq_role}|{request.get_full_path()}|{newest_id}|{version}"
+    etag = quote_etag(hashlib.md5(key.encode('utf-8')).hexdigest())
+    # Edits of existing rows move the version time, not the newest transaction
+    last_modified = int(max(newest_date.timestamp() if newest_date else 0, version))
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = JsonResponse(build())
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    # Clients must revalidate, and shared caches must not mix up users
+    patch_cache_control(response, private=True, no_cache=True)
+    patch_vary_headers(response, ['Cookie'])
+    return response
+
+
+def _student_data(student):
+    return {
+        'id': student.id,
+        'name': student.name,
+        'balance': student.balance,
+        'teacher': student.teacher_name,
+    }
+
+
+def _transaction_data(trans):
+    return {
+        'id': trans.id,
+        'type': trans.type,
+        'amount': trans.amount,
+        'student_id': trans.student_id,
+        'student': trans.student.name,
+        'teacher': trans.teacher_name,
+        'date': trans.date.isoformat(),
+        'comment': trans.comment or '',
+        'edited': trans.edited,
+    }
+
+
+@_api_login_required
+def students(request):
+    """Students visible on the caller's home page, with balances"""
+    role = request.iq_role
+
+    # Same scoping as the home page
+    if role in ['student', 'parent']:
+        queryset = request.iq_students.filter(is_active=True)
+        transactions = Transaction.objects.filter(student__in=request.iq_students)
+    elif role == 'teacher':
+        queryset = Student.objects.filter(teacher=request.user, is_hidden=False, is_active=True)
+        # Balances also move when other teachers award the same students
+        transactions = Transaction.objects.all()
+    elif role == 'admin':
+        queryset = Student.objects.filter(is_hidden=False, is_active=True)
+        transactions = Transaction.objects.all()
+    else:
+        return JsonResponse({'error': 'Permission denied'}, status=403)
+
+    def build():
+        return {'students': [_student_data(student) for student in queryset.order_by('name')]}
+
+    return _conditional_json(request, transactions, build)
+
+
+@_api_login_required
+def transactions(request):
+    """
+    One page of the transaction history, with the same filters as the
+    history page; follow `older`/`newer` with ?after=/?before= (URL-encoded).
+    """
+    queryset = filtered_transactions(request)
+
+    def build():
+        page = keyset_page(
+            queryset.select_related('student'),
+            settings.TRANSACTION_HISTORY_PAGE_SIZE,
+            after=request.GET.get('after'),
+            before=request.GET.get('before'),
+        )
+        return {
+            'transactions': [_transaction_data(trans) for trans in page.items],
+            'newer': page.newer_cursor,
+            'older': page.older_cursor,
+        }
+
+    return _conditional_json(request, queryset, build)
+
+
+@_api_login_required
+def household(request):
+    """Summary of a phone login: its students, total balance and recent transactions"""
+    if request.iq_role not in ['student', 'parent'] or not request.iq_household:
+        return JsonResponse({'error': 'Only available for student and parent logins'}, status=403)
+
+    def build():
+        summary = request.iq_household
+        return {
+            'phone_number': request.session.get('student_phone_number'),
+            'total_balance': summary['total_balance'],
+            'students': [_student_data(student) for student in summary['students']],
+            'recent_transactions': [_transaction_data(trans) for trans in summary['recent_transactions']],
+        }
+
+    return _conditional_json(request, Transaction.objects.filter(student__in=request.iq_students), build)
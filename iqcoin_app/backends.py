@@ -1,6 +1,10 @@
+import logging
 from django.contrib.auth.backends import BaseBackend
 from django.contrib.auth.models import User
 from .models import Student, UserProfile
+from .phones import normalize_phone
+
+logger = logging.getLogger(__name__)
 
 class StudentPhoneBackend(BaseBackend):
     """
@@ -13,52 +17,63 @@ class StudentPhoneBackend(BaseBackend):
         Authenticate a student by phone number.
         Returns a User object if authentication is successful, None otherwise.
         """
+        # "+7 900...", "8 900..." and "900..." all log in the same household
+        phone_number = normalize_phone(phone_number)
         if phone_number is None:
             return None
-            
+
         try:
             # Find students by phone number (may be multiple students sharing the same number)
-            students = Student.objects.filter(phone_number=phone_number, is_active=True)
-            
-            if not students.exists():
+            # One indexed query; the list also gives the count and the first student
+            students = list(
+                Student.objects.filter(phone_normalized=phone_number, is_active=True)
+                .order_by('id')
+                .only('id', 'name')
+            )
+
+            if not students:
                 return None
-            
+
             # Check if this phone number is shared by multiple students (parent login)
-            is_parent = students.count() > 1
-            
+            is_parent = len(students) > 1
+            role = 'parent' if is_parent else 'student'
+
             # Use the first student to create/get the user account
             # All students with this phone number will be shown on the home page
-            student = students.first()
-            
-            # Create or get a user object for this student
+            student = students[0]
+
+            # Get the user for this student together with its profile
             # We'll use a prefix to distinguish student users from regular users
             username = f"student_{student.id}"
-            user, created = User.objects.get_or_create(
-                username=username,
-                defaults={
-                    'first_name': student.name,
-                    'is_active': True,
-                    'is_staff': False,
-                    'is_superuser': False
-                }
-            )
-            
-            # Link the student to the user profile
-            profile, profile_created = UserProfile.objects.get_or_create(user=user)
-            # Always ensure the student is linked and role is correctly set
-            profile.student = student
-            # Assign parent role if multiple students share this phone number
-            profile.role = 'parent' if is_parent else 'student'
-            profile.save()
-            
+            user = User.objects.select_related('userprofile').filter(username=username).first()
+            if user is None:
+                user = User.objects.create(
+                    username=username,
+                    first_name=student.name,
+                    is_active=True,
+                    is_staff=False,
+                    is_superuser=False,
+                )
+
+            # Link the student to the user profile and make sure the role is correct,
+            # writing only when something actually changed
+            try:
+                profile = user.userprofile
+            except UserProfile.DoesNotExist:
+                profile = UserProfile(user=user)
+            if profile.pk is None or profile.student_id != student.id or profile.role != role:
+                profile.student = student
+                profile.role = role
+                profile.save()
+
             # Store the phone number in the session so we can show all students with this phone
-            if request:
+            if request and request.session.get('student_phone_number') != phone_number:
                 request.session['student_phone_number'] = phone_number
-            
+
             return user
-        except Exception as e:
-            # Log the error for debugging
-            print(f"Authentication error: {e}")
+        except Exception:
+            # Log the error with its traceback for debugging
+            logger.exception("Authentication error")
             return None
     
     def get_user(self, user_id):
@@ -2,7 +2,6 @@ from functools import wraps
 from django.contrib.auth.decorators import login_required
 from django.http import HttpResponseForbidden
 from django.shortcuts import redirect
-from .models import UserProfile, Student
 
 def role_required(allowed_roles):
     """
@@ -12,39 +11,9 @@ def role_required(allowed_roles):
         @wraps(view_func)
         @login_required
         def _wrapped_view(request, *args, **kwargs):
-            # Check if user has a profile
-            try:
-                user_profile = request.user.userprofile
-            except UserProfile.DoesNotExist:
-                # Check if this is a student user account (created by the StudentPhoneBackend)
-                if request.user.username.startswith('student_'):
-                    # This is a student user account
-                    # Determine if it's a parent (multiple students with same phone) or student
-                    try:
-                        student = Student.objects.get(id=int(request.user.username.split('_')[1]))
-                        # Count how many students share this phone number
-                        phone_number = student.phone_number
-                        if phone_number:
-                            student_count = Student.objects.filter(phone_number=phone_number, is_active=True).count()
-                            role = 'parent' if student_count > 1 else 'student'
-                        else:
-                            role = 'student'
-                        user_profile = UserProfile.objects.create(user=request.user, role=role, student=student)
-                    except (ValueError, Student.DoesNotExist):
-                        # Fallback to student role if we can't determine
-                        user_profile = UserProfile.objects.create(user=request.user, role='student')
-                # But don't assume it's a teacher - let's check if it's linked to a student
-                elif hasattr(request.user, 'student_set') and request.user.student_set.exists():
-                    # This user is linked to a student, so they should be a student or parent
-                    student_count = request.user.student_set.count()
-                    role = 'parent' if student_count > 1 else 'student'
-                    user_profile = UserProfile.objects.create(user=request.user, role=role)
-                else:
-                    # Default to teacher for staff/admin users
-                    user_profile = UserProfile.objects.create(user=request.user, role='teacher')
-            
             # Check if user has one of the allowed roles
-            if user_profile.role in allowed_roles:
+            # The role is resolved once per session by RoleMiddleware
+            if request.iq_role in allowed_roles:
                 return view_func(request, *args, **kwargs)
             else:
                 return HttpResponseForbidden("You don't have permission to access this page.")
@@ -0,0 +1,84 @@
+import csv
+import tempfile
+import openpyxl
+from django.utils import timezone
+from .models import Transaction
+from .teacher_names import teacher_display_names, teacher_display_name
+
+EXPORT_HEADERS = ['ID', 'Тип', 'Сумма', 'Ученик', 'Педагог', 'Дата', 'Комментарий', 'Изменено']
+TYPE_LABELS = dict(Transaction.TRANSACTION_TYPES)
+# Spreadsheets run cells starting with these as formulas (CSV injection)
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+
+def _text_cell(value):
+    """Free text as a cell value that a spreadsheet shows as text, never runs"""
+    if value and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def export_rows(transactions, chunk_size=2000):
+    """
+    Yield one list of cell values per transaction, newest first.
+
+    Rows are streamed from the database in chunks and teacher names come from
+    the in-process name map, so memory use does not depend on the row count.
+    """
+    teacher_names = teacher_display_names()
+    rows = (
+        transactions.order_by('-date', '-id')
+        .values_list('id', 'type', 'amount', 'student__name', 'teacher_id', 'date', 'comment', 'edited')
+        .iterator(chunk_size=chunk_size)
+    )
+    for trans_id, trans_type, amount, student_name, teacher_id, date, comment, edited in rows:
+        teacher_name = teacher_names.get(teacher_id) or teacher_display_name(teacher_id)
+        yield [
+            trans_id,
+            TYPE_LABELS.get(trans_type, trans_type),
+            amount,
+            _text_cell(student_name),
+            _text_cell(teacher_name),
+            # Local time without tzinfo: spreadsheets can't store aware datetimes
+            timezone.localtime(date).replace(tzinfo=None),
+            _text_cell(comment or ''),
+            'Да' if edited else 'Нет',
+        ]
+
+
+class _Echo:
+    """File-like object that hands back what is written, for csv.writer"""
+
+    def write(self, value):
+        return value
+
+
+def stream_csv(transactions):
+    """Generate CSV text line by line for a StreamingHttpResponse"""
+    writer = csv.writer(_Echo())
+    # BOM so Excel opens the Cyrillic text as UTF-8
+    yield '\ufeff'
+    yield writer.writerow(EXPORT_HEADERS)
+    for row in export_rows(transactions):
+        row[5] = row[5].strftime('%d.%m.%Y %H:%M')
+        yield writer.writerow(row)
+
+
+def write_xlsx(transactions):
+    """
+    Write the transactions to an XLSX temporary file and return it rewound.
+
+    The workbook is in write-only mode, so rows go straight to disk instead of
+    being kept in memory. Unlike the CSV export it is not streamed: the whole
+    file is built before the first byte is sent, because an XLSX is a zip
+    archive that is only complete once saved.
+    """
+    workbook = openpyxl.Workbook(write_only=True)
+    worksheet = workbook.create_sheet('История операций')
+    worksheet.append(EXPORT_HEADERS)
+    for row in export_rows(transactions):
+        worksheet.append(row)
+    output = tempfile.TemporaryFile()
+    workbook.save(output)
+    output.seek(0)
+    return output
@@ -0,0 +1,60 @@
+from django.core.cache import cache
+from django.db import transaction as db_transaction
+from .models import Student, Transaction
+
+# Cache key of the summary shown to a phone login (student or parent)
+HOUSEHOLD_KEY = 'iqcoin:household:{}'
+# Upper bound on staleness should an invalidation ever be missed
+HOUSEHOLD_TIMEOUT = 60 * 60
+
+RECENT_TRANSACTIONS = 10
+
+
+def household_summary(phone_number):
+    """
+    Return the students, total balance and recent transactions of everyone
+    sharing a (normalized) phone number.
+
+    The summary is cached until a Student or Transaction of the household
+    changes, so repeat views of the student home page run no queries.
+    """
+    key = HOUSEHOLD_KEY.format(phone_number)
+    summary = cache.get(key)
+    if summary is None:
+        students = list(
+            Student.objects.filter(phone_normalized=phone_number, is_active=True).order_by('name')
+        )
+        recent_transactions = list(
+            Transaction.objects.filter(student__in=[student.id for student in students])
+            .select_related('student')
+            .order_by('-date', '-id')[:RECENT_TRANSACTIONS]
+        )
+        summary = {
+            'students': students,
+            'total_balance': sum(student.balance for student in students),
+            'recent_transactions': recent_transactions,
+        }
+        cache.set(key, summary, HOUSEHOLD_TIMEOUT)
+    return summary
+
+
+def invalidate_households(phone_numbers):
+    """
+    Drop the cached summaries of the given phone numbers.
+
+    Deferred until the surrounding transaction commits, so a concurrent page
+    view can't cache the old data again in between.
+    """
+    keys = [HOUSEHOLD_KEY.format(phone_number) for phone_number in set(phone_numbers) if phone_number]
+    if keys:
+        db_transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def invalidate_student_households(student_ids):
+    """Drop the cached summaries of the households these students belong to"""
+    phone_numbers = (
+        Student.objects.filter(id__in=set(student_ids))
+        .exclude(phone_normalized=None)
+        .values_list('phone_normalized', flat=True)
+    )
+    invalidate_households(phone_numbers)
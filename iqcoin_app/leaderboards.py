@@ -0,0 +1,417 @@
+import random
+from datetime import timedelta
+from time import monotonic, time
+from django.core.cache import cache
+from django.db import transaction as db_transaction
+from django.db.models import F, Sum
+from django.db.models.functions import TruncMonth, TruncWeek
+from django.utils import timezone
+from .models import CoinsEarned, Student, Transaction
+
+# Leaderboard metrics: current balance, coins earned this week / this month
+METRICS = ('balance', 'week', 'month')
+PERIODS = ('week', 'month')
+
+# Cache key holding a counter bumped on every leaderboard change. Each change
+# is published under LEADERBOARD_CHANGES_KEY with its counter value, so other
+# processes patch their boards with it instead of rebuilding them.
+LEADERBOARD_VERSION_KEY = 'iqcoin:leaderboard_version'
+LEADERBOARD_CHANGES_KEY = 'iqcoin:leaderboard_changes:{}'
+# How long published changes stay available to processes that are behind
+CHANGES_TIMEOUT = 10 * 60
+# A process further behind than this rebuilds instead of replaying
+MAX_REPLAY = 200
+# Boards are rebuilt from the database at least this often, bounding the
+# damage of a change that raced a rebuild
+BOARD_MAX_AGE = 10 * 60
+
+# In-process boards: (metric, period start) -> _Board
+_boards = {}
+_boards_version = None
+
+# Levels of the skip lists: enough for 2**32 students
+MAX_LEVEL = 32
+
+
+class _Node:
+    __slots__ = ('key', 'next', 'width')
+
+    def __init__(self, key, level):
+        self.key = key
+        self.next = [None] * level
+        # Number of positions each link skips
+        self.width = [1] * level
+
+
+class _SkipList:
+    """
+    Sorted keys with O(log n) expected insert, remove and position lookups,
+    an indexable skip list: each link knows how many keys it skips.
+    """
+
+    def __init__(self):
+        self.head = _Node(None, MAX_LEVEL)
+        self.size = 0
+
+    def _path(self, key):
+        """The last node before `key` on every level, and its position"""
+        path = [None] * MAX_LEVEL
+        positions = [0] * MAX_LEVEL
+        node = self.head
+        position = 0
+        for level in reversed(range(MAX_LEVEL)):
+            while node.next[level] is not None and node.next[level].key < key:
+                position += node.width[level]
+                node = node.next[level]
+            path[level] = node
+            positions[level] = position
+        return path, positions
+
+    def insert(self, key):
+        path, positions = self._path(key)
+        level_count = 1
+        while level_count < MAX_LEVEL and random.random() < 0.5:
+            level_count += 1
+        node = _Node(key, level_count)
+        position = positions[0] + 1
+        for level in range(level_count):
+            before = path[level]
+            node.next[level] = before.next[level]
+            before.next[level] = node
+            node.width[level] = before.width[level] - (position - positions[level]) + 1
+            before.width[level] = position - positions[level]
+        for level in range(level_count, MAX_LEVEL):
+            path[level].width[level] += 1
+        self.size += 1
+
+    def remove(self, key):
+        path, _ = self._path(key)
+        node = path[0].next[0]
+        if node is None or node.key != key:
+            raise KeyError(key)
+        for level in range(MAX_LEVEL):
+            before = path[level]
+            if level < len(node.next):
+                before.width[level] += node.width[level] - 1
+                before.next[level] = node.next[level]
+            else:
+                before.width[level] -= 1
+        self.size -= 1
+
+    def bisect_left(self, key):
+        """Number of keys lower than `key`"""
+        node = self.head
+        position = 0
+        for level in reversed(range(MAX_LEVEL)):
+            while node.next[level] is not None and node.next[level].key < key:
+                position += node.width[level]
+                node = node.next[level]
+        return position
+
+    def first(self, limit):
+        keys = []
+        node = self.head.next[0]
+        while node is not None and len(keys) < limit:
+            keys.append(node.key)
+            node = node.next[0]
+        return keys
+
+    def __len__(self):
+        return self.size
+
+
+class _Ranking:
+    """Students ordered by score, with O(log n) updates and rank lookups"""
+
+    def __init__(self):
+        self.scores = {}
+        # (-score, student id) keys: highest score first, ties by id
+        self.keys = _SkipList()
+
+    def set(self, student_id, score):
+        old = self.scores.pop(student_id, None)
+        if old is not None:
+            self.keys.remove((-old, student_id))
+        if score is not None:
+            self.scores[student_id] = score
+            self.keys.insert((-score, student_id))
+
+    def top(self, limit):
+        return [(student_id, -score) for score, student_id in self.keys.first(limit)]
+
+    def rank(self, student_id):
+        """Return (rank, score) with equal scores sharing a rank, or None"""
+        score = self.scores.get(student_id)
+        if score is None:
+            return None
+        return self.keys.bisect_left((-score,)) + 1, score
+
+    def __len__(self):
+        return len(self.keys)
+
+
+class _Board:
+    """A school-wide ranking together with one ranking per teacher"""
+
+    def __init__(self, rows):
+        self.built_at = monotonic()
+        self.school = _Ranking()
+        self.teachers = {}
+        self.teacher_of = {}
+        for student_id, teacher_id, score in rows:
+            self.set(student_id, teacher_id, score)
+
+    def set(self, student_id, teacher_id, score):
+        """Set a student's score and teacher; a score of None takes the student off"""
+        self.school.set(student_id, score)
+        old_teacher_id = self.teacher_of.pop(student_id, None)
+        if old_teacher_id is not None and old_teacher_id != teacher_id:
+            self.teachers[old_teacher_id].set(student_id, None)
+        if score is None:
+            if teacher_id in self.teachers:
+                self.teachers[teacher_id].set(student_id, None)
+            return
+        self.teacher_of[student_id] = teacher_id
+        self.teachers.setdefault(teacher_id, _Ranking()).set(student_id, score)
+
+    def add(self, student_id, teacher_id, delta):
+        self.set(student_id, teacher_id, self.school.scores.get(student_id, 0) + delta)
+
+    def ranking(self, teacher_id=None):
+        if teacher_id is None:
+            return self.school
+        return self.teachers.get(teacher_id) or _Ranking()
+
+
+def period_start(period, when=None):
+    """First day of the week (Monday) or month containing `when` (default: now)"""
+    day = timezone.localdate(when)
+    if period == 'week':
+        return day - timedelta(days=day.weekday())
+    return day.replace(day=1)
+
+
+def _board_key(metric):
+    return (metric, period_start(metric) if metric in PERIODS else None)
+
+
+def _load_board(metric, start):
+    # Hidden and inactive students are left off every leaderboard
+    if metric == 'balance':
+        rows = (
+            Student.objects.filter(is_active=True, is_hidden=False)
+            .values_list('id', 'teacher_id', 'balance')
+        )
+    else:
+        rows = (
+            CoinsEarned.objects.filter(
+                period=metric,
+                period_start=start,
+                student__is_active=True,
+                student__is_hidden=False,
+            )
+            .values_list('student_id', 'student__teacher_id', 'amount')
+        )
+    return _Board(rows.iterator())
+
+
+def _current_version():
+    version = cache.get(LEADERBOARD_VERSION_KEY)
+    if version is None:
+        # Restart from the clock, so a lost counter can't come back to a
+        # value some process still has boards for
+        cache.add(LEADERBOARD_VERSION_KEY, int(time() * 1000), None)
+        version = cache.get(LEADERBOARD_VERSION_KEY)
+    return version
+
+
+def _catch_up(version):
+    """Bring this process' boards to `version`, replaying published changes or dropping the boards"""
+    global _boards, _boards_version
+    if _boards and _boards_version is not None and 0 < version - _boards_version <= MAX_REPLAY:
+        keys = [LEADERBOARD_CHANGES_KEY.format(missed) for missed in range(_boards_version + 1, version + 1)]
+        published = cache.get_many(keys)
+        # A missing entry is an invalidation, or a change that expired
+        if len(published) == len(keys):
+            for key in keys:
+                _patch(published[key])
+        else:
+            _boards = {}
+    else:
+        _boards = {}
+    _boards_version = version
+
+
+def _board(metric):
+    """The current board for a metric, built with one query when missing or stale"""
+    global _boards
+    version = _current_version()
+    if version != _boards_version:
+        _catch_up(version)
+
+    key = _board_key(metric)
+    board = _boards.get(key)
+    if board is None or monotonic() - board.built_at > BOARD_MAX_AGE:
+        # Boards of past weeks and months are not needed any more
+        current = {_board_key(name) for name in METRICS}
+        _boards = {k: v for k, v in _boards.items() if k in current}
+        board = _load_board(*key)
+        # A change committed during the load may already be in the board;
+        # keep it only if none was, so no change is ever applied twice
+        if _current_version() == _boards_version:
+            _boards[key] = board
+    return board
+
+
+def top(metric, teacher_id=None, limit=10):
+    """Return the first `limit` (student id, score) pairs of a leaderboard"""
+    return _board(metric).ranking(teacher_id).top(limit)
+
+
+def rank(metric, student_id, teacher_id=None):
+    """Return (rank, score) of a student on a leaderboard, or None if not on it"""
+    return _board(metric).ranking(teacher_id).rank(student_id)
+
+
+def board_size(metric, teacher_id=None):
+    return len(_board(metric).ranking(teacher_id))
+
+
+def _bump_version():
+    """Bump the shared version and return the new value (None if the cache lost it)"""
+    try:
+        return cache.incr(LEADERBOARD_VERSION_KEY)
+    except ValueError:
+        return None
+
+
+def _publish(changes):
+    """
+    Publish committed score changes under a new version. Every process,
+    this one included, applies them to its boards on next use.
+    """
+    version = _bump_version()
+    if version is not None:
+        cache.set(LEADERBOARD_CHANGES_KEY.format(version), changes, CHANGES_TIMEOUT)
+
+
+def _patch(changes):
+    """Apply published changes to the boards this process has loaded"""
+    for operation, key, student_id, teacher_id, value in changes:
+        board = _boards.get(key)
+        if board is None:
+            continue
+        if operation == 'add':
+            board.add(student_id, teacher_id, value)
+        else:
+            board.set(student_id, teacher_id, value)
+
+
+def record(students, balance_delta, earned=0, when=None):
+    """
+    Record a ledger write for the leaderboards: every student's balance moved
+    by `balance_delta` and `earned` coins were awarded at `when`.
+
+    The coins earned are stored right away, in the caller's transaction;
+    the change is published to the in-memory boards once it commits.
+    """
+    students = list(students)
+    if not students or not (balance_delta or earned):
+        return
+    changes = []
+    for student in students:
+        if not student.is_active or student.is_hidden:
+            continue
+        if balance_delta:
+            changes.append(('add', ('balance', None), student.pk, student.teacher_id, balance_delta))
+
+    if earned:
+        student_ids = [student.pk for student in students]
+        for period in PERIODS:
+            start = period_start(period, when)
+            # Make sure every row exists, then add to all of them in one UPDATE
+            CoinsEarned.objects.bulk_create(
+                [CoinsEarned(student_id=student_id, period=period, period_start=start) for student_id in student_ids],
+                ignore_conflicts=True,
+            )
+            CoinsEarned.objects.filter(period=period, period_start=start, student_id__in=student_ids).update(
+                amount=F('amount') + earned
+            )
+            for student in students:
+                if student.is_active and not student.is_hidden:
+                    changes.append(('add', (period, start), student.pk, student.teacher_id, earned))
+
+    db_transaction.on_commit(lambda: _publish(changes))
+
+
+def record_student(student, previous):
+    """
+    Record a saved Student for the leaderboards. `previous` is its (teacher
+    id, balance, shown on boards) before the save, or None for a new student.
+
+    Nothing is published unless the balance, teacher or visibility changed.
+    """
+    teacher_id, balance = student.teacher_id, student.balance
+    shown = student.is_active and not student.is_hidden
+    if previous == (teacher_id, balance, shown):
+        return
+    changes = [('set', ('balance', None), student.pk, teacher_id, balance if shown else None)]
+    if previous is not None and (previous[0] != teacher_id or previous[2] != shown):
+        # The coins earned stay; the student moves to another teacher or
+        # comes onto or off the boards with them
+        starts = {period: period_start(period) for period in PERIODS}
+        earned = {
+            period: amount
+            for period, start, amount in CoinsEarned.objects.filter(
+                student_id=student.pk, period_start__in=starts.values()
+            ).values_list('period', 'period_start', 'amount')
+            if starts[period] == start
+        }
+        for period, start in starts.items():
+            amount = earned.get(period) if shown else None
+            changes.append(('set', (period, start), student.pk, teacher_id, amount))
+    db_transaction.on_commit(lambda: _publish(changes))
+
+
+def remove_student(student):
+    """Take a deleted Student off every current board"""
+    changes = [('set', _board_key(metric), student.pk, student.teacher_id, None) for metric in METRICS]
+    db_transaction.on_commit(lambda: _publish(changes))
+
+
+def invalidate_leaderboards():
+    """Make every process rebuild its boards, e.g. after a bulk import"""
+    global _boards, _boards_version
+    # A version without published changes can't be replayed
+    db_transaction.on_commit(_bump_version)
+    _boards = {}
+    _boards_version = None
+
+
+def rebuild_coins_earned(batch_size=1000):
+    """
+    Recompute all CoinsEarned rows from the award transactions in the ledger.
+    Returns the number of rows written.
+    """
+    written = 0
+    with db_transaction.atomic():
+        CoinsEarned.objects.all().delete()
+        for period, trunc in (('week', TruncWeek), ('month', TruncMonth)):
+            totals = (
+                Transaction.objects.filter(type='AWARD')
+                .annotate(start=trunc('date', output_field=CoinsEarned._meta.get_field('period_start')))
+                .values_list('student_id', 'start')
+                .annotate(total=Sum('amount'))
+                .order_by()
+            )
+            batch = []
+            for student_id, start, total in totals.iterator():
+                batch.append(CoinsEarned(student_id=student_id, period=period, period_start=start, amount=total))
+                if len(batch) >= batch_size:
+                    CoinsEarned.objects.bulk_create(batch)
+                    written += len(batch)
+                    batch = []
+            CoinsEarned.objects.bulk_create(batch)
+            written += len(batch)
+        invalidate_leaderboards()
+    return written
@@ -0,0 +1,123 @@
+from collections import namedtuple
+from django.db import transaction as db_transaction
+from django.db.models import F
+from .models import Student, Transaction
+from . import analytics, leaderboards, search
+from .households import invalidate_student_households
+
+# Result of awarding coins to a single student
+AwardResult = namedtuple('AwardResult', ['student', 'transaction', 'balance'])
+
+
+def award_coins(students, amount, teacher, comment=None):
+    """
+    Award the same amount of coins to every given student.
+
+    Writes all ledger rows with one bulk insert and moves all balances with
+    one UPDATE, so the cost does not grow with the number of students.
+    Returns a list of AwardResult in the order the students were given.
+    """
+    students = list(students)
+    if not students:
+        return []
+
+    student_ids = [student.pk for student in students]
+
+    with db_transaction.atomic():
+        # One INSERT for the whole batch of ledger rows
+        transactions = Transaction.objects.bulk_create([
+            Transaction(
+                type='AWARD',
+                amount=amount,
+                student=student,
+                teacher=teacher,
+                comment=comment,
+            )
+            for student in students
+        ])
+        # bulk_create sends no post_save, so index the new rows for search here
+        search.index_transactions(transactions)
+        # One UPDATE for all balances, computed by the database
+        Student.objects.filter(pk__in=student_ids).update(balance=F('balance') + amount)
+        # Read back the balances the database actually ended up with
+        balances = dict(
+            Student.objects.filter(pk__in=student_ids).values_list('pk', 'balance')
+        )
+        # Neither bulk_create nor update() send signals
+        invalidate_student_households(student_ids)
+        analytics.record_transactions(transactions)
+        leaderboards.record(students, amount, earned=amount, when=transactions[0].date)
+
+    results = []
+    for student, trans in zip(students, transactions):
+        student.balance = balances.get(student.pk, student.balance)
+        results.append(AwardResult(student, trans, student.balance))
+    return results
+
+
+def deduct_coins(student, amount, teacher, comment=None):
+    """
+    Deduct coins from a student if the balance covers it.
+
+    The balance check and the decrement are a single conditional UPDATE, so
+    concurrent deductions can never overdraw a student or lose an update.
+    Returns the new Transaction, or None if the balance was insufficient.
+    """
+    with db_transaction.atomic():
+        updated = Student.objects.filter(pk=student.pk, balance__gte=amount).update(
+            balance=F('balance') - amount
+        )
+        if not updated:
+            return None
+        # The ledger row is only written once the balance has really moved
+        trans = Transaction.objects.create(
+            type='DEDUCT',
+            amount=amount,
+            student=student,
+            teacher=teacher,
+            comment=comment,
+        )
+        analytics.record_transactions([trans])
+        leaderboards.record([student], -amount)
+    student.balance -= amount
+    return trans
+
+
+def change_award_amount(trans, old_amount, new_amount):
+    """
+    Change the amount of an award transaction and adjust the balance to match.
+
+    old_amount is the amount currently stored for the transaction (a bound
+    ModelForm has already overwritten trans.amount by the time it validates).
+    Lowering an award is refused if the student has already spent the coins.
+    Returns the balance difference applied, or None if it was refused.
+    """
+    difference = new_amount - old_amount
+    with db_transaction.atomic():
+        # The household cache is dropped by the Transaction post_save below
+        updated = Student.objects.filter(pk=trans.student_id, balance__gte=-difference).update(
+            balance=F('balance') + difference
+        )
+        if not updated:
+            trans.amount = old_amount
+            return None
+        trans.amount = new_amount
+        trans.edited = True
+        trans.save(update_fields=['amount', 'edited'])
+        # The award counts for the day, week and month it was originally made in
+        analytics.record_amount_change(trans, difference)
+        leaderboards.record([trans.student], difference, earned=difference, when=trans.date)
+    return difference
+
+
+def count_transactions(transactions, sign=1):
+    """
+    Add (sign=1) or take out (sign=-1) transactions that were written or
+    removed outside this module (the Django admin) from the daily rollup and
+    the coins earned. Balances are left alone, as the admin edit left them.
+    """
+    transactions = list(transactions)
+    analytics.record_transactions(transactions, sign)
+    for trans in transactions:
+        if trans.type == 'AWARD':
+            leaderboards.record([trans.student], 0, earned=sign * trans.amount, when=trans.date)
@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+from iqcoin_app.models import Student
+from iqcoin_app import ledger
+
+class Command(BaseCommand):
+    help = 'Award IQ-coins to a set of students in one bulk operation'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--teacher',
+            type=str,
+            required=True,
+            help='Username of the teacher the awards are recorded for',
+        )
+        parser.add_argument(
+            '--amount',
+            type=int,
+            required=True,
+            help='Number of IQ-coins to award to each student',
+        )
+        parser.add_argument(
+            '--student-ids',
+            nargs='+',
+            type=int,
+            help='IDs of students to award (default: all active, non-hidden students of the teacher)',
+        )
+        parser.add_argument(
+            '--comment',
+            type=str,
+            default=None,
+            help='Optional comment stored on every transaction',
+        )
+
+    def handle(self, *args, **options):
+        try:
+            teacher = User.objects.get(username=options['teacher'])
+        except User.DoesNotExist:
+            self.stdout.write(self.style.ERROR(f'User {options["teacher"]} does not exist'))
+            return
+
+        if options['amount'] < 1:
+            self.stdout.write(self.style.ERROR('Amount must be a positive number'))
+            return
+
+        if options['student_ids']:
+            students = Student.objects.filter(id__in=options['student_ids'])
+        else:
+            students = Student.objects.filter(teacher=teacher, is_hidden=False, is_active=True)
+
+        results = ledger.award_coins(students, options['amount'], teacher, comment=options['comment'])
+        for result in results:
+            self.stdout.write(f'{result.student.name}: balance {result.balance}')
+        self.stdout.write(
+            self.style.SUCCESS(f'Awarded {options["amount"]} IQ-coins to {len(results)} students')
+        )
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from iqcoin_app.analytics import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = 'Recompute the daily transaction rollup used by the statistics page from the ledger'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Rows written per bulk insert (default: 1000)',
+        )
+
+    def handle(self, *args, **options):
+        written = rebuild_rollups(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Rollup rebuilt. Rows: {written}"))
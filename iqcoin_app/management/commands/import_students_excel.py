@@ -1,214 +1,219 @@
-import openpyxl
+import glob
+import multiprocessing
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
 from django.core.management.base import BaseCommand
-from django.contrib.auth.models import User
-from iqcoin_app.models import Student, UserProfile
+from iqcoin_app.roster_import import RosterImporter
+from iqcoin_app.roster_parsing import iter_roster_source, list_sheets, parse_roster_source, read_spilled_records
 
 
 class Command(BaseCommand):
-    help = 'Import students from Excel file "Ученики Айкьюшки.xlsx"'
-    
+    help = 'Import students from Excel file "Ученики Айкьюшки.xlsx" (or other workbooks and CSV/TSV exports)'
+
     def add_arguments(self, parser):
         parser.add_argument(
             '--file',
             type=str,
-            default='Ученики Айкьюшки.xlsx',
-            help='Path to the Excel file (default: Ученики Айкьюшки.xlsx)',
+            nargs='+',
+            default=['Ученики Айкьюшки.xlsx'],
+            help='Paths or glob patterns of Excel, CSV or TSV files (default: Ученики Айкьюшки.xlsx)',
         )
         parser.add_argument(
             '--sheet',
             type=str,
             default='Лист1',
-            help='Sheet name to import from (default: Лист1)',
+            help='Sheet name to import from, Excel only (default: Лист1)',
+        )
+        parser.add_argument(
+            '--all-sheets',
+            action='store_true',
+            help='Import every sheet of each workbook instead of --sheet',
+        )
+        parser.add_argument(
+            '--format',
+            choices=['auto', 'xlsx', 'csv', 'tsv'],
+            default='auto',
+            help='File format (default: guessed from the file extension)',
+        )
+        parser.add_argument(
+            '--delimiter',
+            type=str,
+            default=None,
+            help='CSV delimiter (default: guessed from the header line)',
         )
-    
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=os.cpu_count() or 1,
+            help='Processes used to parse files in parallel (default: number of CPUs)',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Number of students written per bulk query (default: 500)',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Report what would be created or updated without writing anything',
+        )
+        parser.add_argument(
+            '--full',
+            action='store_true',
+            help='Compare every row with the database, not only rows whose content changed since the last import',
+        )
+        parser.add_argument(
+            '--deactivate-removed',
+            action='store_true',
+            help='Mark students that disappeared from the file since the last import as inactive',
+        )
+
     def handle(self, *args, **options):
-        file_path = options['file']
-        sheet_name = options['sheet']
-        
+        self.verbose = options['verbosity'] > 1
+        # Sources that could not be read at all
+        self.failed_sources = 0
+        sources = self._collect_sources(options)
+        if not sources:
+            if self.failed_sources:
+                self.stdout.write(self.style.ERROR(f"Import failed. Failed sources: {self.failed_sources}"))
+            return
+
         try:
-            # Load the workbook and select the sheet
-            workbook = openpyxl.load_workbook(file_path)
-            worksheet = workbook[sheet_name]
-            
-            # Get all teacher full names and map them to User objects
-            teacher_mapping = {}
-            teachers = User.objects.filter(userprofile__role='teacher')
-            for teacher in teachers:
-                profile = teacher.userprofile
-                if profile.full_name:
-                    teacher_mapping[profile.full_name.strip()] = teacher
-                # Also map by username as fallback
-                teacher_mapping[teacher.username] = teacher
-            
-            self.stdout.write(f"Found {len(teacher_mapping)} teachers in the database")
-            
-            # Parse the header row
-            header_row = next(worksheet.iter_rows(values_only=True))
-            headers = [str(cell).strip() if cell else '' for cell in header_row]
-            
-            # Expected headers mapping
-            header_mapping = {
-                'student_name': ['student_name', 'имя_ученика', 'student_name\xa0'],
-                'teacher_full_name': ['teacher_full_name', 'учитель', 'teacher_full_name '],
-                'phone_number': ['phone_number', 'номер_телефона', 'phone_number '],
-                'is_active': ['is_active', 'активен', 'is_active\xa0'],
-                'is_hidden': ['is_hidden', 'скрыт', 'is_hidden\xa0'],
-            }
-            
-            # Map column indices
-            column_indices = {}
-            for i, header in enumerate(headers):
-                for field, possible_headers in header_mapping.items():
-                    if header in possible_headers:
-                        column_indices[field] = i
-                        break
-            
-            # Check if required columns are present
-            if 'student_name' not in column_indices:
-                self.stdout.write(
-                    self.style.ERROR("Required column 'student_name' not found in the Excel file")
-                )
-                return
-            
-            if 'teacher_full_name' not in column_indices:
-                self.stdout.write(
-                    self.style.ERROR("Required column 'teacher_full_name' not found in the Excel file")
-                )
-                return
-            
-            # Process each row
-            imported_count = 0
-            skipped_count = 0
-            error_count = 0
-            
-            # Skip header row and process data rows
-            for row_num, row in enumerate(worksheet.iter_rows(values_only=True), start=1):
-                # Skip header row
-                if row_num == 1:
-                    continue
-                
-                # Skip empty rows
-                if not any(cell is not None for cell in row):
-                    continue
-                
-                try:
-                    # Extract values from row
-                    student_name = self._get_cell_value(row, column_indices, 'student_name')
-                    teacher_name = self._get_cell_value(row, column_indices, 'teacher_full_name')
-                    phone_number = self._get_cell_value(row, column_indices, 'phone_number')
-                    is_active_str = self._get_cell_value(row, column_indices, 'is_active')
-                    is_hidden_str = self._get_cell_value(row, column_indices, 'is_hidden')
-                    
-                    # Skip if student name is empty
-                    if not student_name:
-                        skipped_count += 1
-                        continue
-                    
-                    # Process boolean values
-                    is_active = self._parse_boolean(is_active_str, default=True)
-                    is_hidden = self._parse_boolean(is_hidden_str, default=False)
-                    
-                    # Find teacher
-                    teacher = None
-                    if teacher_name:
-                        teacher_name_clean = teacher_name.strip()
-                        if teacher_name_clean in teacher_mapping:
-                            teacher = teacher_mapping[teacher_name_clean]
-                        else:
-                            # Try to find teacher by username
-                            try:
-                                teacher = User.objects.get(username=teacher_name_clean)
-                            except User.DoesNotExist:
-                                self.stdout.write(
-                                    self.style.WARNING(
-                                        f"Teacher '{teacher_name_clean}' not found for student '{student_name}' on row {row_num}. Skipping."
-                                    )
-                                )
-                                error_count += 1
-                                continue
-                    
-                    # If no teacher found, skip this student
-                    if not teacher:
-                        self.stdout.write(
-                            self.style.WARNING(
-                                f"No teacher found for student '{student_name}' on row {row_num}. Skipping."
-                            )
-                        )
-                        error_count += 1
-                        continue
-                    
-                    # Create or update student
-                    student, created = Student.objects.get_or_create(
-                        name=student_name.strip(),
-                        teacher=teacher,
-                        defaults={
-                            'phone_number': phone_number.strip() if phone_number else None,
-                            'is_active': is_active,
-                            'is_hidden': is_hidden,
-                            'balance': 0,
-                        }
-                    )
-                    
-                    if created:
-                        imported_count += 1
-                        self.stdout.write(
-                            self.style.SUCCESS(
-                                f"Imported student '{student_name}' assigned to teacher '{teacher_name}'"
-                            )
-                        )
-                    else:
-                        # Update existing student
-                        student.phone_number = phone_number.strip() if phone_number else None
-                        student.is_active = is_active
-                        student.is_hidden = is_hidden
-                        student.save()
-                        self.stdout.write(
-                            self.style.SUCCESS(
-                                f"Updated student '{student_name}'"
-                            )
-                        )
-                        imported_count += 1
-                        
-                except Exception as e:
-                    self.stdout.write(
-                        self.style.ERROR(
-                            f"Error processing row {row_num}: {str(e)}"
-                        )
-                    )
-                    error_count += 1
-            
-            # Summary
-            self.stdout.write(
-                self.style.SUCCESS(
-                    f"Import completed. Imported/Updated: {imported_count}, Skipped: {skipped_count}, Errors: {error_count}"
-                )
-            )
-            
-        except FileNotFoundError:
-            self.stdout.write(
-                self.style.ERROR(f"File '{file_path}' not found")
+            importer = RosterImporter(
+                batch_size=options['batch_size'],
+                dry_run=options['dry_run'],
+                full=options['full'],
+                deactivate_removed=options['deactivate_removed'],
+                log=self._log,
             )
         except Exception as e:
             self.stdout.write(
                 self.style.ERROR(f"Error importing students: {str(e)}")
             )
-    
-    def _get_cell_value(self, row, column_indices, field_name):
-        """Helper method to safely get cell value"""
-        if field_name in column_indices and column_indices[field_name] < len(row):
-            value = row[column_indices[field_name]]
-            return str(value) if value is not None else None
-        return None
-    
-    def _parse_boolean(self, value, default=False):
-        """Helper method to parse boolean values from various formats"""
-        if value is None:
-            return default
-        
-        value_str = str(value).strip().lower()
-        if value_str in ['yes', 'true', '1', 'да', 'active']:
-            return True
-        elif value_str in ['no', 'false', '0', 'нет', 'inactive']:
-            return False
-        else:
-            return default
\ No newline at end of file
+            return
+        self.stdout.write(f"Found {len(importer.teacher_mapping)} teachers in the database")
+
+        totals = {'created': 0, 'updated': 0, 'unchanged': 0, 'removed': 0, 'skipped': 0, 'errors': 0}
+        started = time.monotonic()
+
+        # Files are parsed in worker processes; this process is the only one
+        # writing, so SQLite never sees competing writers. With one worker the
+        # records stream straight from the file into the importer.
+        workers = max(1, min(options['workers'], len(sources)))
+        executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+        manager = multiprocessing.Manager() if executor else None
+        spill_dir = tempfile.TemporaryDirectory(prefix='roster-import-') if executor else None
+        jobs = []
+        try:
+            if executor:
+                # Every source is queued at once: workers spill parsed chunks to
+                # disk instead of waiting for the writer, so memory holds at most
+                # one chunk of --batch-size records per worker plus the writer's
+                for index, (source, task) in enumerate(sources):
+                    chunks = manager.Queue()
+                    spill_path = os.path.join(spill_dir.name, f"{index}.pickle")
+                    future = executor.submit(parse_roster_source, chunks, spill_path, options['batch_size'], *task)
+                    jobs.append((chunks, spill_path, future))
+
+            # Write in the order given, so a student listed in several files
+            # always ends up with the values of the last one
+            for index, (source, task) in enumerate(sources):
+                if executor:
+                    records = read_spilled_records(*jobs[index])
+                else:
+                    records = iter_roster_source(*task)
+                stats = {'rows': 0, 'read_seconds': 0.0}
+
+                try:
+                    write_started = time.monotonic()
+                    counts = importer.import_source(source, self._timed(records, stats))
+                    write_seconds = time.monotonic() - write_started - stats['read_seconds']
+                except FileNotFoundError:
+                    self.stdout.write(self.style.ERROR(f"{source}: file not found"))
+                    self.failed_sources += 1
+                    continue
+                except Exception as e:
+                    self.stdout.write(self.style.ERROR(f"{source}: error importing students: {str(e)}"))
+                    self.failed_sources += 1
+                    continue
+
+                for key in totals:
+                    totals[key] += counts[key]
+                self.stdout.write(
+                    f"{source}: {stats['rows']} rows read in {stats['read_seconds']:.2f}s, written in {write_seconds:.2f}s "
+                    f"(created {counts['created']}, updated {counts['updated']}, unchanged {counts['unchanged']}, "
+                    f"removed {counts['removed']}, errors {counts['errors']})"
+                )
+        finally:
+            if executor:
+                # Workers must be done with their spill files before they go
+                executor.shutdown(cancel_futures=True)
+                manager.shutdown()
+                spill_dir.cleanup()
+
+        # Summary; a source that failed as a whole counts as one error
+        totals['errors'] += self.failed_sources
+        prefix = "Dry run completed (nothing written)." if options['dry_run'] else "Import completed."
+        summary = (
+            f"{prefix} Sources: {len(sources)}, Failed sources: {self.failed_sources}, "
+            f"Created: {totals['created']}, Updated: {totals['updated']}, "
+            f"Unchanged: {totals['unchanged']}, Removed: {totals['removed']}, "
+            f"Skipped: {totals['skipped']}, Errors: {totals['errors']}, "
+            f"Time: {time.monotonic() - started:.2f}s"
+        )
+        self.stdout.write(self.style.ERROR(summary) if self.failed_sources else self.style.SUCCESS(summary))
+
+    def _timed(self, records, stats):
+        """Pass records through, counting them and the time spent waiting for them"""
+        records = iter(records)
+        while True:
+            started = time.monotonic()
+            try:
+                record = next(records)
+            except StopIteration:
+                return
+            finally:
+                stats['read_seconds'] += time.monotonic() - started
+            stats['rows'] += 1
+            yield record
+
+    def _collect_sources(self, options):
+        """Expand the file patterns into (source name, parse arguments) pairs"""
+        sources = []
+        for pattern in options['file']:
+            # Keep patterns without matches so the missing file gets reported
+            paths = sorted(glob.glob(pattern)) or [pattern]
+            for file_path in paths:
+                file_format = options['format']
+                if file_format == 'auto':
+                    extension = os.path.splitext(file_path)[1].lower()
+                    file_format = {'.csv': 'csv', '.tsv': 'tsv', '.txt': 'csv'}.get(extension, 'xlsx')
+
+                # Row hashes are remembered per file name (and sheet for Excel)
+                if file_format != 'xlsx':
+                    delimiter = '\t' if file_format == 'tsv' else options['delimiter']
+                    sources.append((os.path.basename(file_path), (file_path, file_format, None, delimiter)))
+                    continue
+
+                sheet_names = [options['sheet']]
+                if options['all_sheets']:
+                    try:
+                        sheet_names = list_sheets(file_path)
+                    except FileNotFoundError:
+                        self.stdout.write(self.style.ERROR(f"File '{file_path}' not found"))
+                        self.failed_sources += 1
+                        continue
+                for sheet_name in sheet_names:
+                    source = f"{os.path.basename(file_path)}:{sheet_name}"
+                    sources.append((source, (file_path, file_format, sheet_name, None)))
+        return sources
+
+    def _log(self, level, message):
+        """Print row-level messages; only errors unless -v 2 is given"""
+        if level == 'error':
+            self.stdout.write(self.style.ERROR(message))
+        elif self.verbose:
+            self.stdout.write(self.style.WARNING(message) if level == 'warning' else message)
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from iqcoin_app.leaderboards import rebuild_coins_earned
+
+
+class Command(BaseCommand):
+    help = 'Recompute the weekly and monthly coins-earned leaderboards from the transaction ledger'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Rows written per bulk insert (default: 1000)',
+        )
+
+    def handle(self, *args, **options):
+        written = rebuild_coins_earned(batch_size=options['batch_size'])
+        # Balance leaderboards are read straight from Student.balance; every
+        # process rebuilds its boards on next use
+        self.stdout.write(self.style.SUCCESS(f"Leaderboards rebuilt. Coins earned rows: {written}"))
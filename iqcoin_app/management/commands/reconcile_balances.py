@@ -0,0 +1,112 @@
+from contextlib import nullcontext
+from django.core.management.base import BaseCommand
+from django.db import transaction as db_transaction
+from iqcoin_app.api import invalidate_api_etags
+from iqcoin_app.households import invalidate_student_households
+from iqcoin_app.leaderboards import invalidate_leaderboards
+from iqcoin_app.models import Student, Transaction
+
+
+class Command(BaseCommand):
+    help = 'Check that every Student.balance matches the Transaction ledger, optionally fixing drift'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--fix',
+            action='store_true',
+            help='Set drifted balances to the value computed from the ledger',
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=5000,
+            help='Rows fetched per round trip while streaming (default: 5000)',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Students updated per bulk_update when fixing (default: 500)',
+        )
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        batch_size = options['batch_size']
+        fix = options['fix']
+
+        checked_count = 0
+        drift_count = 0
+        fixed_count = 0
+        drifted = []
+
+        # When fixing, read and write in one transaction so the ledger can't
+        # move between computing a balance and storing it
+        with db_transaction.atomic() if fix else nullcontext():
+            # Both streams are ordered by student id and merged, so memory stays
+            # constant whatever the size of the ledger
+            students = (
+                Student.objects.order_by('id')
+                .values_list('id', 'name', 'balance')
+                .iterator(chunk_size=chunk_size)
+            )
+            ledger_rows = (
+                Transaction.objects.order_by('student_id')
+                .values_list('student_id', 'type', 'amount')
+                .iterator(chunk_size=chunk_size)
+            )
+            ledger_row = next(ledger_rows, None)
+
+            for student_id, name, balance in students:
+                expected = 0
+                # Ledger rows for students that no longer exist can't be reconciled
+                while ledger_row is not None and ledger_row[0] < student_id:
+                    ledger_row = next(ledger_rows, None)
+                while ledger_row is not None and ledger_row[0] == student_id:
+                    if ledger_row[1] == 'DEDUCT':
+                        expected -= ledger_row[2]
+                    else:
+                        expected += ledger_row[2]
+                    ledger_row = next(ledger_rows, None)
+
+                checked_count += 1
+                if balance == expected:
+                    continue
+
+                drift_count += 1
+                self.stdout.write(
+                    self.style.WARNING(
+                        f"Student '{name}' (id {student_id}): balance {balance}, ledger {expected}, drift {balance - expected}"
+                    )
+                )
+                if expected < 0:
+                    self.stdout.write(
+                        self.style.ERROR(f"Ledger total for student id {student_id} is negative; not fixing")
+                    )
+                    continue
+                if fix:
+                    drifted.append(Student(id=student_id, balance=expected))
+                    if len(drifted) >= batch_size:
+                        fixed_count += self._write(drifted)
+                        drifted = []
+
+            if fix:
+                fixed_count += self._write(drifted)
+                if fixed_count:
+                    invalidate_leaderboards()
+                    invalidate_api_etags()
+
+        summary = f"Reconciliation completed. Checked: {checked_count}, Drifted: {drift_count}"
+        if fix:
+            summary += f", Fixed: {fixed_count}"
+        self.stdout.write(self.style.SUCCESS(summary) if not drift_count or fix else self.style.WARNING(summary))
+
+    def _write(self, drifted):
+        """
+        Store one batch of reconciled balances. Only students the merge has
+        already passed are written, so the open read cursors never meet them.
+        """
+        if not drifted:
+            return 0
+        Student.objects.bulk_update(drifted, ['balance'])
+        invalidate_student_households(student.id for student in drifted)
+        return len(drifted)
@@ -0,0 +1,197 @@
+import json
+import logging
+from functools import partial
+from time import perf_counter
+from uuid import uuid4
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from django.utils.functional import SimpleLazyObject
+from .models import UserProfile, Student
+from .phones import normalize_phone
+from .households import household_summary
+
+# Session key holding the resolved role of the logged-in user
+ROLE_SESSION_KEY = 'iq_role_cache'
+# Cache key holding the current profile version of a user; bumping it
+# invalidates the role cached in every session of that user
+PROFILE_VERSION_KEY = 'iqcoin:profile_version:{}'
+
+
+def resolve_user_profile(user):
+    """
+    Get the user's profile, creating one with a best-guess role if it is missing.
+    """
+    try:
+        return user.userprofile
+    except UserProfile.DoesNotExist:
+        pass
+
+    # Check if this is a student user account (created by the StudentPhoneBackend)
+    if user.username.startswith('student_'):
+        # Determine if it's a parent (multiple students with same phone) or student
+        try:
+            student = Student.objects.get(id=int(user.username.split('_')[1]))
+            # Count how many students share this phone number
+            phone_number = student.phone_normalized
+            if phone_number:
+                student_count = Student.objects.filter(phone_normalized=phone_number, is_active=True).count()
+                role = 'parent' if student_count > 1 else 'student'
+            else:
+                role = 'student'
+            return UserProfile.objects.create(user=user, role=role, student=student)
+        except (ValueError, Student.DoesNotExist):
+            # Fallback to student role if we can't determine
+            return UserProfile.objects.create(user=user, role='student')
+    # But don't assume it's a teacher - let's check if it's linked to a student
+    elif hasattr(user, 'student_set') and user.student_set.exists():
+        student_count = user.student_set.count()
+        role = 'parent' if student_count > 1 else 'student'
+        return UserProfile.objects.create(user=user, role=role)
+    # Default to teacher for staff/admin users
+    return UserProfile.objects.create(user=user, role='teacher')
+
+
+def _profile_version(user_id):
+    key = PROFILE_VERSION_KEY.format(user_id)
+    version = cache.get(key)
+    if version is None:
+        version = uuid4().hex
+        cache.set(key, version, None)
+    return version
+
+
+def invalidate_user_role(user_id):
+    """Force every session of this user to resolve the role again"""
+    cache.delete(PROFILE_VERSION_KEY.format(user_id))
+
+
+class RoleMiddleware:
+    """
+    Resolve the role and linked students of the logged-in user once and keep
+    them in the session, so views don't query the profile on every request.
+    Writes (POST and the like) always resolve the role from the database.
+
+    Sets request.iq_role (None for anonymous users), request.iq_full_name,
+    request.iq_students (a lazy queryset of the students a student or parent
+    login is linked to; empty for staff) and request.iq_household (the lazily
+    loaded, cached household summary of a phone login; None otherwise).
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.iq_role = None
+        request.iq_full_name = None
+        request.iq_students = Student.objects.none()
+        request.iq_household = None
+
+        if request.user.is_authenticated:
+            self._attach_role(request)
+
+        return self.get_response(request)
+
+    def _attach_role(self, request):
+        user = request.user
+        version = _profile_version(user.id)
+        cached = request.session.get(ROLE_SESSION_KEY)
+
+        # Writes never trust the session copy: if a role change has not reached
+        # this worker's cache yet, a demoted user must still lose their rights
+        writing = request.method not in ('GET', 'HEAD', 'OPTIONS')
+        if writing or not cached or cached.get('user_id') != user.id or cached.get('version') != version:
+            profile = resolve_user_profile(user)
+            resolved = {
+                'user_id': user.id,
+                'version': version,
+                'role': profile.role,
+                'full_name': profile.full_name,
+                'student_id': profile.student_id,
+                'phone_number': profile.student.phone_normalized if profile.student_id else None,
+            }
+            # Only save the session when something changed
+            if resolved != cached:
+                cached = request.session[ROLE_SESSION_KEY] = resolved
+
+        request.iq_role = cached['role']
+        request.iq_full_name = cached['full_name']
+
+        if cached['role'] in ['student', 'parent']:
+            # Phone logins see every student sharing the phone number
+            # (sessions from before phone normalization may hold the raw number)
+            phone_number = normalize_phone(request.session.get('student_phone_number')) or cached['phone_number']
+            if phone_number:
+                if 'student_phone_number' not in request.session:
+                    request.session['student_phone_number'] = phone_number
+                request.iq_students = Student.objects.filter(phone_normalized=phone_number)
+                request.iq_household = SimpleLazyObject(partial(household_summary, phone_number))
+            elif cached['student_id']:
+                request.iq_students = Student.objects.filter(id=cached['student_id'])
+
+
+# Logger of RequestTimingMiddleware: one line per request, a warning when slow
+timing_logger = logging.getLogger('iqcoin_app.requests')
+
+
+class RequestTimingMiddleware:
+    """
+    Measure every request: resolved view, role, wall time, number of SQL
+    queries and time spent in them. The figures are sent back as a
+    Server-Timing header and logged as one JSON line, at WARNING level when
+    the request exceeds REQUEST_TIMING_MAX_QUERIES or REQUEST_TIMING_MAX_MS.
+
+    Enabled with REQUEST_TIMING; when it is off Django drops the middleware
+    at startup, so it costs nothing. Queries are counted with a database
+    execute wrapper, so DEBUG does not need to be on. The body of streamed
+    responses (exports) is sent after the measurement ends.
+    """
+
+    def __init__(self, get_response):
+        if not settings.REQUEST_TIMING:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.max_queries = settings.REQUEST_TIMING_MAX_QUERIES
+        self.max_ms = settings.REQUEST_TIMING_MAX_MS
+
+    def __call__(self, request):
+        # [query count, seconds in SQL] of this request
+        sql = [0, 0.0]
+
+        def record_query(execute, query, params, many, context):
+            start = perf_counter()
+            try:
+                return execute(query, params, many, context)
+            finally:
+                sql[0] += 1
+                sql[1] += perf_counter() - start
+
+        start = perf_counter()
+        with connection.execute_wrapper(record_query):
+            response = self.get_response(request)
+        total_ms = (perf_counter() - start) * 1000
+        queries, sql_ms = sql[0], sql[1] * 1000
+
+        response['Server-Timing'] = (
+            f'sql;desc="{queries} queries";dur={sql_ms:.1f}, '
+            f'app;dur={total_ms - sql_ms:.1f}, '
+            f'total;dur={total_ms:.1f}'
+        )
+
+        match = request.resolver_match
+        record = {
+            'method': request.method,
+            'path': request.path,
+            'view': match.view_name if match else None,
+            'role': getattr(request, 'iq_role', None),
+            'status': response.status_code,
+            'ms': round(total_ms, 1),
+            'queries': queries,
+            'sql_ms': round(sql_ms, 1),
+        }
+        if queries > self.max_queries or total_ms > self.max_ms:
+            timing_logger.warning('slow request %s', json.dumps(record, ensure_ascii=False))
+        else:
+            timing_logger.info('request %s', json.dumps(record, ensure_ascii=False))
+        return response
@@ -0,0 +1,44 @@
+# Generated by Django 4.2.11 on 2026-10-18 01:40
+
+import logging
+from django.db import migrations, models
+
+logger = logging.getLogger('iqcoin_app.migrations')
+
+ADJUSTMENT_COMMENT = 'Корректировка отрицательного баланса (миграция 0013)'
+
+
+def clamp_negative_balances(apps, schema_editor):
+    """
+    Concurrent deductions could push a balance below zero before this
+    constraint existed. Reset those balances to 0, recording the difference
+    as an award so the ledger still adds up, and log each student.
+    """
+    Student = apps.get_model('iqcoin_app', 'Student')
+    Transaction = apps.get_model('iqcoin_app', 'Transaction')
+    for student in Student.objects.filter(balance__lt=0).order_by('id'):
+        logger.warning("Student %s (%s): negative balance %s reset to 0", student.id, student.name, student.balance)
+        Transaction.objects.create(
+            type='AWARD',
+            amount=-student.balance,
+            student=student,
+            teacher_id=student.teacher_id,
+            comment=ADJUSTMENT_COMMENT,
+        )
+        student.balance = 0
+        student.save(update_fields=['balance'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('iqcoin_app', '0012_alter_transaction_type_alter_userprofile_role'),
+    ]
+
+    operations = [
+        migrations.RunPython(clamp_negative_balances, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='student',
+            constraint=models.CheckConstraint(check=models.Q(('balance__gte', 0)), name='student_balance_non_negative'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 4.2.11 on 2026-10-18 01:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('iqcoin_app', '0013_student_balance_non_negative'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='student',
+            index=models.Index(fields=['teacher', 'name'], name='student_teacher_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='student',
+            index=models.Index(condition=models.Q(('is_active', True), ('is_hidden', False)), fields=['name'], name='student_visible_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='student',
+            index=models.Index(fields=['phone_number', 'is_active'], name='student_phone_active_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['student', '-date', '-id'], name='transaction_student_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['teacher', '-date', '-id'], name='transaction_teacher_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['-date', '-id'], name='transaction_date_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+from django.db import migrations
+
+FTS_TABLE = 'iqcoin_app_transaction_fts'
+
+
+def create_fts_table(apps, schema_editor):
+    # FTS5 is SQLite-only; other backends fall back to icontains search
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+        "comment, student_name, teacher_name, tokenize = 'unicode61 remove_diacritics 2')"
+    )
+    # Index the existing ledger
+    schema_editor.execute(
+        f"INSERT INTO {FTS_TABLE} (rowid, comment, student_name, teacher_name) "
+        "SELECT t.id, COALESCE(t.comment, ''), s.name, TRIM(u.username || ' ' || COALESCE(p.full_name, '')) "
+        "FROM iqcoin_app_transaction t "
+        "JOIN iqcoin_app_student s ON s.id = t.student_id "
+        "JOIN auth_user u ON u.id = t.teacher_id "
+        "LEFT JOIN iqcoin_app_userprofile p ON p.user_id = u.id"
+    )
+
+
+def drop_fts_table(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(f"DROP TABLE IF EXISTS {FTS_TABLE}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('iqcoin_app', '0014_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fts_table, drop_fts_table),
+    ]
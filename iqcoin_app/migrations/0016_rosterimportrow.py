@@ -0,0 +1,30 @@
+# Generated by Django 4.2.11 on 2026-10-18 01:48
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('iqcoin_app', '0015_transaction_fts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RosterImportRow',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(max_length=255)),
+                ('name', models.CharField(max_length=100)),
+                ('content_hash', models.CharField(max_length=40)),
+                ('teacher', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='rosterimportrow',
+            constraint=models.UniqueConstraint(fields=('source', 'name', 'teacher'), name='roster_import_row_unique'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.2.11 on 2026-10-18 01:52
+
+from django.db import migrations, models
+from iqcoin_app.phones import normalize_phone
+
+
+def backfill_phone_normalized(apps, schema_editor):
+    Student = apps.get_model('iqcoin_app', 'Student')
+    students = list(Student.objects.exclude(phone_number__isnull=True).exclude(phone_number='').only('id', 'phone_number'))
+    for student in students:
+        student.phone_normalized = normalize_phone(student.phone_number)
+    Student.objects.bulk_update(students, ['phone_normalized'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('iqcoin_app', '0016_rosterimportrow'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='student',
+            name='student_phone_active_idx',
+        ),
+        migrations.AddField(
+            model_name='student',
+            name='phone_normalized',
+            field=models.CharField(blank=True, editable=False, max_length=15, null=True),
+        ),
+        migrations.RunPython(backfill_phone_normalized, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='student',
+            index=models.Index(fields=['phone_normalized', 'is_active'], name='student_phone_active_idx'),
+        ),
+    ]
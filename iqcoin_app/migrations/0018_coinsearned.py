@@ -0,0 +1,28 @@
+# Generated by Django 4.2.11 on 2026-10-18 01:56
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('iqcoin_app', '0017_student_phone_normalized'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CoinsEarned',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('week', 'Неделя'), ('month', 'Месяц')], max_length=5)),
+                ('period_start', models.DateField()),
+                ('amount', models.IntegerField(default=0)),
+                ('student', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='iqcoin_app.student')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='coinsearned',
+            constraint=models.UniqueConstraint(fields=('period', 'period_start', 'student'), name='coins_earned_unique'),
+        ),
+    ]
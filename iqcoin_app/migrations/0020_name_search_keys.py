@@ -0,0 +1,47 @@
+# Generated by Django 4.2.11 on 2026-10-18 02:02
+
+from django.db import migrations, models
+from iqcoin_app.search_keys import fold_search_key
+
+
+def backfill_search_keys(apps, schema_editor):
+    Student = apps.get_model('iqcoin_app', 'Student')
+    students = list(Student.objects.only('id', 'name'))
+    for student in students:
+        student.name_search = fold_search_key(student.name)
+    Student.objects.bulk_update(students, ['name_search'], batch_size=500)
+
+    UserProfile = apps.get_model('iqcoin_app', 'UserProfile')
+    profiles = list(UserProfile.objects.exclude(full_name__isnull=True).exclude(full_name='').only('id', 'full_name'))
+    for profile in profiles:
+        profile.full_name_search = fold_search_key(profile.full_name)
+    UserProfile.objects.bulk_update(profiles, ['full_name_search'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('iqcoin_app', '0019_transactiondailyrollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='student',
+            name='name_search',
+            field=models.CharField(blank=True, default='', editable=False, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='full_name_search',
+            field=models.CharField(blank=True, default='', editable=False, max_length=100),
+        ),
+        migrations.RunPython(backfill_search_keys, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='student',
+            index=models.Index(fields=['teacher', 'name_search'], name='student_teacher_search_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='student',
+            index=models.Index(fields=['name_search'], name='student_name_search_idx'),
+        ),
+    ]
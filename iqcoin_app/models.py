@@ -1,5 +1,8 @@
 from django.db import models
 from django.contrib.auth.models import User
+from .phones import normalize_phone
+from .search_keys import fold_search_key
+from .teacher_names import teacher_display_name
 
 # Define user roles
 USER_ROLES = (
@@ -16,33 +19,85 @@ class UserProfile(models.Model):
     student = models.ForeignKey('Student', on_delete=models.SET_NULL, null=True, blank=True)
     # Full name for better identification
     full_name = models.CharField(max_length=100, blank=True, null=True)
+    # Casefolded full_name used by searches (kept in sync on save)
+    full_name_search = models.CharField(max_length=100, blank=True, default='', editable=False)
     # Color for teachers to identify their students in the UI
     color = models.CharField(max_length=7, blank=True, null=True, help_text="Hex color code (e.g., #FF5733)")
     
+    def save(self, *args, **kwargs):
+        self.full_name_search = fold_search_key(self.full_name)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'full_name' in update_fields:
+            kwargs['update_fields'] = set(update_fields) | {'full_name_search'}
+        super().save(*args, **kwargs)
+
     def __str__(self):
         return f"{self.user.username} - {self.get_role_display()}"
 
 class Student(models.Model):
     name = models.CharField(max_length=100)
+    # Casefolded name used by searches (kept in sync on save)
+    name_search = models.CharField(max_length=100, blank=True, default='', editable=False)
     teacher = models.ForeignKey(User, on_delete=models.CASCADE, related_name='students')
     balance = models.IntegerField(default=0)
     # Phone number for student login (can be shared by multiple students, e.g., siblings)
     phone_number = models.CharField(max_length=15, blank=True, null=True)
+    # Digits-only form of phone_number used for lookups (kept in sync on save)
+    phone_normalized = models.CharField(max_length=15, blank=True, null=True, editable=False)
     # Flag to indicate if student account is active
     is_active = models.BooleanField(default=True)
     # Flag to hide student from general lists (home page, award/deduct forms)
     is_hidden = models.BooleanField(default=False)
 
+    class Meta:
+        constraints = [
+            # Balances can never go negative, even under concurrent deductions
+            models.CheckConstraint(check=models.Q(balance__gte=0), name='student_balance_non_negative'),
+        ]
+        indexes = [
+            # home (teacher): filter(teacher, is_hidden=False, is_active=True).order_by('name')
+            # student_list (teacher): filter(teacher).order_by('name')
+            # award_coins/deduct_coins forms (teacher): filter(teacher, is_hidden=False).order_by('name')
+            # history student filter (teacher): filter(teacher).order_by('name', 'id')
+            models.Index(fields=['teacher', 'name'], name='student_teacher_name_idx'),
+            # api students (admin): filter(is_hidden=False, is_active=True).order_by('name')
+            # (home (admin) orders by the teacher's username, which no Student index can serve)
+            models.Index(
+                fields=['name'],
+                condition=models.Q(is_hidden=False, is_active=True),
+                name='student_visible_name_idx',
+            ),
+            # history student filter (admin): order_by('name', 'id'), paged from a cursor
+            models.Index(fields=['name', 'id'], name='student_name_id_idx'),
+            # StudentPhoneBackend / RoleMiddleware (student, parent):
+            # filter(phone_normalized, is_active=True) and filter(phone_normalized)
+            models.Index(fields=['phone_normalized', 'is_active'], name='student_phone_active_idx'),
+            # history student filter ?q= (teacher): filter(teacher, name_search range), see prefix_filter
+            models.Index(fields=['teacher', 'name_search'], name='student_teacher_search_idx'),
+            # history student filter ?q= (admin): filter(name_search range)
+            models.Index(fields=['name_search'], name='student_name_search_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.phone_normalized = normalize_phone(self.phone_number)
+        self.name_search = fold_search_key(self.name)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            update_fields = set(update_fields)
+            if 'phone_number' in update_fields:
+                update_fields.add('phone_normalized')
+            if 'name' in update_fields:
+                update_fields.add('name_search')
+            kwargs['update_fields'] = update_fields
+        super().save(*args, **kwargs)
+
+    @property
+    def teacher_name(self):
+        # Teacher's full name, fallback to username (cached, no query per row)
+        return teacher_display_name(self.teacher_id)
+
     def __str__(self):
-        # Try to get the teacher's full name, fallback to username
-        try:
-            if hasattr(self.teacher, 'userprofile') and self.teacher.userprofile.full_name:
-                teacher_name = self.teacher.userprofile.full_name
-            else:
-                teacher_name = self.teacher.username
-        except:
-            teacher_name = self.teacher.username
-        return f"{self.name} ({teacher_name})"
+        return f"{self.name} ({self.teacher_name})"
 
 class Transaction(models.Model):
     TRANSACTION_TYPES = (
@@ -57,13 +112,86 @@ class Transaction(models.Model):
     comment = models.TextField(blank=True, null=True)
     edited = models.BooleanField(default=False)
 
+    class Meta:
+        # Every index ends with -id so it also serves the (date, id) keyset
+        # ordering used by transaction_history without a sort step.
+        indexes = [
+            # transaction_history / home / student_detail (student, parent):
+            # filter(student__in=...) or filter(student).order_by('-date')
+            models.Index(fields=['student', '-date', '-id'], name='transaction_student_date_idx'),
+            # transaction_history / home (teacher): filter(teacher).order_by('-date')
+            models.Index(fields=['teacher', '-date', '-id'], name='transaction_teacher_date_idx'),
+            # transaction_history / home (admin): all().order_by('-date')
+            models.Index(fields=['-date', '-id'], name='transaction_date_idx'),
+        ]
+
+    @property
+    def teacher_name(self):
+        # Teacher's full name, fallback to username (cached, no query per row)
+        return teacher_display_name(self.teacher_id)
+
+    def __str__(self):
+        return f"{self.type} {self.amount} for {self.student} by {self.teacher_name}"
+
+class RosterImportRow(models.Model):
+    """
+    Content hash of one student row as last imported from a roster file,
+    so the next import of the same file can skip rows that did not change.
+    """
+    # File name and sheet the row was imported from
+    source = models.CharField(max_length=255)
+    name = models.CharField(max_length=100)
+    teacher = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    content_hash = models.CharField(max_length=40)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['source', 'name', 'teacher'], name='roster_import_row_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.source}: {self.name}"
+
+class CoinsEarned(models.Model):
+    """
+    Coins awarded to a student during one week or month, kept up to date by
+    the ledger for the earned-coins leaderboards.
+    """
+    PERIODS = (
+        ('week', 'Неделя'),
+        ('month', 'Месяц'),
+    )
+    student = models.ForeignKey(Student, on_delete=models.CASCADE, related_name='+')
+    period = models.CharField(max_length=5, choices=PERIODS)
+    # Monday of the week or first day of the month
+    period_start = models.DateField()
+    amount = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['period', 'period_start', 'student'], name='coins_earned_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.student_id}: {self.amount} ({self.period} {self.period_start})"
+
+class TransactionDailyRollup(models.Model):
+    """
+    Number and total amount of transactions of one type per day, teacher and
+    student, kept up to date by the ledger so statistics never scan Transaction.
+    """
+    day = models.DateField()
+    teacher = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    student = models.ForeignKey(Student, on_delete=models.CASCADE, related_name='+')
+    type = models.CharField(max_length=10, choices=Transaction.TRANSACTION_TYPES)
+    count = models.IntegerField(default=0)
+    amount = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            # Also serves the analytics page: filter(day__range=...)
+            models.UniqueConstraint(fields=['day', 'teacher', 'student', 'type'], name='transaction_rollup_unique'),
+        ]
+
     def __str__(self):
-        # Try to get the teacher's full name, fallback to username
-        try:
-            if hasattr(self.teacher, 'userprofile') and self.teacher.userprofile.full_name:
-                teacher_name = self.teacher.userprofile.full_name
-            else:
-                teacher_name = self.teacher.username
-        except:
-            teacher_name = self.teacher.username
-        return f"{self.type} {self.amount} for {self.student} by {teacher_name}"
\ No newline at end of file
+        return f"{self.day} {self.type} {self.count}x {self.amount} for {self.student_id} by {self.teacher_id}"
@@ -0,0 +1,83 @@
+from collections import namedtuple
+from datetime import datetime
+from django.db.models import Q
+
+# One page of a keyset-paginated queryset.
+# newer_cursor/older_cursor are None when there is nothing in that direction.
+KeysetPage = namedtuple('KeysetPage', ['items', 'newer_cursor', 'older_cursor'])
+
+
+def encode_cursor(obj):
+    """Build a cursor string from the (date, id) position of a row"""
+    return f"{obj.date.isoformat()}_{obj.id}"
+
+
+def decode_cursor(cursor):
+    """Parse a cursor string back into (date, id), or None if it is malformed"""
+    if not cursor:
+        return None
+    try:
+        date_str, id_str = cursor.rsplit('_', 1)
+        return datetime.fromisoformat(date_str), int(id_str)
+    except (ValueError, TypeError):
+        return None
+
+
+def keyset_page(queryset, page_size, after=None, before=None):
+    """
+    Return one page of a queryset ordered newest first by (date, id).
+
+    `after` pages towards older rows and `before` towards newer rows. Each page
+    is a range seek on (date, id) instead of an OFFSET, so deep pages cost the
+    same as the first one.
+    """
+    after = decode_cursor(after)
+    before = decode_cursor(before)
+
+    rows = None
+    if before:
+        # Walk forward in time from the cursor, then flip back to newest first
+        date, pk = before
+        rows = list(
+            queryset.filter(Q(date__gt=date) | Q(date=date, id__gt=pk))
+            .order_by('date', 'id')[:page_size + 1]
+        )
+        has_newer = len(rows) > page_size
+        items = list(reversed(rows[:page_size]))
+        has_older = True
+
+    if not rows:
+        # No cursor, an older-page cursor, or nothing newer left: seek backwards
+        if after and not before:
+            date, pk = after
+            queryset = queryset.filter(Q(date__lt=date) | Q(date=date, id__lt=pk))
+        else:
+            after = None
+        rows = list(queryset.order_by('-date', '-id')[:page_size + 1])
+        has_older = len(rows) > page_size
+        items = rows[:page_size]
+        has_newer = after is not None
+
+    newer_cursor = encode_cursor(items[0]) if items and has_newer else None
+    older_cursor = encode_cursor(items[-1]) if items and has_older else None
+    return KeysetPage(items, newer_cursor, older_cursor)
+
+
+def name_page(queryset, page_size, after=None):
+    """
+    Return (items, next_cursor) for one page of a queryset ordered by
+    (name, id), continuing after an `after` cursor from a previous page.
+    """
+    if after:
+        try:
+            id_str, name = after.split('_', 1)
+            pk = int(id_str)
+        except ValueError:
+            pass
+        else:
+            queryset = queryset.filter(Q(name__gt=name) | Q(name=name, id__gt=pk))
+    rows = list(queryset.order_by('name', 'id')[:page_size + 1])
+    items = rows[:page_size]
+    # id first: names may contain the separator
+    next_cursor = f"{items[-1].id}_{items[-1].name}" if len(rows) > page_size else None
+    return items, next_cursor
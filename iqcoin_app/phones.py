@@ -0,0 +1,24 @@
+import re
+
+_NON_DIGITS = re.compile(r'\D')
+
+
+def normalize_phone(phone_number):
+    """
+    Reduce a phone number to its digits in international form, so that
+    "+7 900 123-45-67", "8 (900) 123-45-67" and "9001234567" compare equal.
+
+    Returns None for empty input.
+    """
+    if not phone_number:
+        return None
+    digits = _NON_DIGITS.sub('', phone_number)
+    if not digits:
+        return None
+    # Russian numbers: a leading 8 is the domestic form of +7
+    if len(digits) == 11 and digits.startswith('8'):
+        digits = '7' + digits[1:]
+    # Ten digits without a country code
+    elif len(digits) == 10 and digits.startswith('9'):
+        digits = '7' + digits
+    return digits
@@ -0,0 +1,47 @@
+from .models import Transaction
+from . import search
+
+# Querysets shared by the HTML views and the JSON API. Nothing here renders
+# or answers requests, so both can import it without importing each other.
+
+
+def filtered_transactions(request):
+    """
+    Transactions visible to the current user, narrowed by the student, type
+    and search filters in the query string. Shared by the history page, its
+    export and the JSON API.
+    """
+    role = request.iq_role
+    
+    # Role-based access
+    if role in ['student', 'parent']:
+        # Students and parents can see transactions for all students with their phone number
+        # (both active and inactive to ensure we catch all transactions)
+        transactions = Transaction.objects.filter(student__in=request.iq_students).order_by('-date')
+    elif role == 'teacher':
+        # Teachers can only see transactions they made
+        transactions = Transaction.objects.filter(teacher=request.user).order_by('-date')
+    elif role == 'admin':
+        # Admins can see all transactions
+        transactions = Transaction.objects.all().order_by('-date')
+    else:
+        # Default: teachers can only see transactions they made
+        transactions = Transaction.objects.filter(teacher=request.user).order_by('-date')
+    
+    # Filter by student if specified (only for teachers and admins)
+    student_filter = request.GET.get('student')
+    if student_filter and role in ['teacher', 'admin']:
+        transactions = transactions.filter(student_id=student_filter)
+    
+    # Filter by transaction type if specified
+    type_filter = request.GET.get('type')
+    if type_filter:
+        transactions = transactions.filter(type=type_filter)
+    
+    # Search functionality (only for teachers and admins)
+    search_query = request.GET.get('search')
+    if search_query and role in ['teacher', 'admin']:
+        # Full-text index over comments, student and teacher names
+        transactions = search.filter_transactions(transactions, search_query)
+    
+    return transactions
@@ -0,0 +1,215 @@
+import hashlib
+from django.contrib.auth.models import User
+from django.db import transaction as db_transaction
+from .models import Student, RosterImportRow
+from .phones import normalize_phone
+from .search_keys import fold_search_key
+from .households import invalidate_households
+from .leaderboards import invalidate_leaderboards
+from .api import invalidate_api_etags
+from .student_lookup import invalidate_student_lookup
+
+# Fields written by the import, compared to decide whether a student changed
+IMPORT_FIELDS = ('phone_number', 'is_active', 'is_hidden')
+# Written along with IMPORT_FIELDS; bulk queries bypass Student.save()
+UPDATE_FIELDS = IMPORT_FIELDS + ('phone_normalized',)
+
+
+def load_teacher_mapping():
+    """Map teacher full names and usernames to User objects with one query"""
+    teacher_mapping = {}
+    users = list(User.objects.exclude(username__startswith='student_').select_related('userprofile'))
+    for user in users:
+        teacher_mapping.setdefault(user.username, user)
+    # Teachers' full names take precedence over any username
+    for user in users:
+        profile = getattr(user, 'userprofile', None)
+        if profile and profile.role == 'teacher' and profile.full_name:
+            teacher_mapping[profile.full_name.strip()] = user
+    return teacher_mapping
+
+
+class RosterImporter:
+    """
+    Batched write pipeline shared by every roster format.
+
+    Records from iter_roster_records() are hashed and compared with the hashes
+    remembered from the previous import of the same source; only new or
+    changed rows are looked up and written, with bulk queries.
+
+    `log` is called as log(level, message) with level 'detail', 'warning' or
+    'error'.
+    """
+
+    def __init__(self, batch_size=500, dry_run=False, full=False, deactivate_removed=False, log=None):
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.full = full
+        self.deactivate_removed = deactivate_removed
+        self.log = log or (lambda level, message: None)
+        self.teacher_mapping = load_teacher_mapping()
+
+    def import_source(self, source, records):
+        """Import one file or sheet in a single transaction and return its counts"""
+        self.source = source
+        self.counts = {'created': 0, 'updated': 0, 'unchanged': 0, 'removed': 0, 'skipped': 0, 'errors': 0}
+        # Content hashes from the previous import of this source, in one query
+        self.known = {
+            (row.name, row.teacher_id): row
+            for row in RosterImportRow.objects.filter(source=source)
+        }
+        seen = set()
+        pending = {}
+
+        with db_transaction.atomic():
+            for record in records:
+                record = self._resolve(record)
+                if record is None:
+                    continue
+
+                key = (record['name'], record['teacher'].id)
+                content_hash = self._hash_record(record)
+                seen.add(key)
+                state = self.known.get(key)
+                if not self.full and key not in pending and state is not None and state.content_hash == content_hash:
+                    # Same content as last time: nothing to look up or write
+                    self.counts['unchanged'] += 1
+                    continue
+
+                # A repeated row in the file replaces the pending one
+                pending[key] = (record, content_hash)
+                if len(pending) >= self.batch_size:
+                    self._flush(pending)
+
+            self._flush(pending)
+            self._handle_removed(seen)
+
+        return self.counts
+
+    def _resolve(self, record):
+        """Attach the teacher to a parsed record, or count it as skipped/failed"""
+        if 'error' in record:
+            self.log('error', f"Error processing row {record['row_num']}: {record['error']}")
+            self.counts['errors'] += 1
+            return None
+
+        # Skip if student name is empty
+        if not record['name']:
+            self.counts['skipped'] += 1
+            return None
+
+        teacher = self.teacher_mapping.get(record['teacher_name']) if record['teacher_name'] else None
+        if not teacher:
+            self.log(
+                'warning',
+                f"Teacher '{record['teacher_name']}' not found for student '{record['name']}' "
+                f"on row {record['row_num']}. Skipping.",
+            )
+            self.counts['errors'] += 1
+            return None
+
+        record['teacher'] = teacher
+        return record
+
+    def _hash_record(self, record):
+        """Stable hash of the values a row writes to its student"""
+        values = [record['name'], str(record['teacher'].id)] + [str(record[field]) for field in IMPORT_FIELDS]
+        return hashlib.sha1('\x1f'.join(values).encode('utf-8')).hexdigest()
+
+    def _find_students(self, keys):
+        """Existing students for a batch of (name, teacher id) keys, in one query"""
+        students = {}
+        queryset = (
+            Student.objects.filter(
+                name__in={name for name, _ in keys},
+                teacher_id__in={teacher_id for _, teacher_id in keys},
+            )
+            .only('id', 'name', 'teacher_id', 'phone_normalized', *IMPORT_FIELDS)
+            .order_by('id')
+        )
+        for student in queryset:
+            key = (student.name, student.teacher_id)
+            if key in keys:
+                students.setdefault(key, student)
+        return students
+
+    def _flush(self, pending):
+        """Diff a batch of changed rows against the database and write it with bulk queries"""
+        if not pending:
+            return
+        existing = self._find_students(pending)
+        to_create = []
+        to_update = []
+        new_states = []
+        changed_states = []
+        changed_phones = set()
+
+        for key, (record, content_hash) in pending.items():
+            student = existing.get(key)
+            if student is None:
+                to_create.append(Student(
+                    name=record['name'],
+                    name_search=fold_search_key(record['name']),
+                    teacher=record['teacher'],
+                    balance=0,
+                    phone_normalized=normalize_phone(record['phone_number']),
+                    **{field: record[field] for field in IMPORT_FIELDS}
+                ))
+                self.log('detail', f"Create student '{record['name']}'")
+            elif any(getattr(student, field) != record[field] for field in IMPORT_FIELDS):
+                # Both the old and the new household change
+                changed_phones.add(student.phone_normalized)
+                for field in IMPORT_FIELDS:
+                    setattr(student, field, record[field])
+                student.phone_normalized = normalize_phone(student.phone_number)
+                to_update.append(student)
+                self.log('detail', f"Update student '{record['name']}'")
+            else:
+                self.counts['unchanged'] += 1
+
+            # Remember the content for the next import
+            state = self.known.get(key)
+            if state is None:
+                state = RosterImportRow(source=self.source, name=key[0], teacher_id=key[1], content_hash=content_hash)
+                new_states.append(state)
+                self.known[key] = state
+            elif state.content_hash != content_hash:
+                state.content_hash = content_hash
+                changed_states.append(state)
+
+        self.counts['created'] += len(to_create)
+        self.counts['updated'] += len(to_update)
+        if not self.dry_run:
+            Student.objects.bulk_create(to_create, batch_size=self.batch_size)
+            Student.objects.bulk_update(to_update, UPDATE_FIELDS, batch_size=self.batch_size)
+            RosterImportRow.objects.bulk_create(new_states, batch_size=self.batch_size)
+            RosterImportRow.objects.bulk_update(changed_states, ['content_hash'], batch_size=self.batch_size)
+            # Bulk writes send no signals, so drop the cached household pages here
+            changed_phones.update(student.phone_normalized for student in to_create + to_update)
+            invalidate_households(changed_phones)
+            if to_create or to_update:
+                invalidate_leaderboards()
+                invalidate_api_etags()
+                invalidate_student_lookup()
+        pending.clear()
+
+    def _handle_removed(self, seen):
+        """Forget rows that are no longer in the source, optionally deactivating their students"""
+        removed = [key for key in self.known if key not in seen]
+        self.counts['removed'] = len(removed)
+
+        for start in range(0, len(removed), self.batch_size):
+            batch = set(removed[start:start + self.batch_size])
+            for name, _ in batch:
+                self.log('detail', f"Removed from file: '{name}'")
+            if self.dry_run:
+                continue
+            if self.deactivate_removed:
+                students = list(self._find_students(batch).values())
+                for student in students:
+                    student.is_active = False
+                Student.objects.bulk_update(students, ['is_active'], batch_size=self.batch_size)
+                invalidate_households(student.phone_normalized for student in students)
+                invalidate_leaderboards()
+                invalidate_api_etags()
+            RosterImportRow.objects.filter(id__in=[self.known[key].id for key in batch]).delete()
@@ -0,0 +1,202 @@
+import csv
+import pickle
+import time
+from queue import Empty
+import openpyxl
+
+# Roster file parsing for the student import. Nothing here touches Django or
+# the database, so it can run in worker processes while RosterImporter
+# writes from the main process.
+
+# Expected headers mapping: field -> accepted column titles
+HEADER_MAPPING = {
+    'student_name': ['student_name', 'имя_ученика', 'student_name\xa0'],
+    'teacher_full_name': ['teacher_full_name', 'учитель', 'teacher_full_name '],
+    'phone_number': ['phone_number', 'номер_телефона', 'phone_number '],
+    'is_active': ['is_active', 'активен', 'is_active\xa0'],
+    'is_hidden': ['is_hidden', 'скрыт', 'is_hidden\xa0'],
+}
+
+REQUIRED_COLUMNS = ('student_name', 'teacher_full_name')
+
+
+def parse_boolean(value, default=False):
+    """Parse boolean values from various formats"""
+    if value is None:
+        return default
+
+    value_str = str(value).strip().lower()
+    if value_str in ['yes', 'true', '1', 'да', 'active']:
+        return True
+    elif value_str in ['no', 'false', '0', 'нет', 'inactive']:
+        return False
+    else:
+        return default
+
+
+def map_columns(header_row):
+    """Map field names to column indices using the known header aliases"""
+    headers = [str(cell).strip() if cell else '' for cell in header_row]
+
+    column_indices = {}
+    for i, header in enumerate(headers):
+        for field, possible_headers in HEADER_MAPPING.items():
+            if header in possible_headers:
+                column_indices[field] = i
+                break
+    return column_indices
+
+
+def _get_cell_value(row, column_indices, field_name):
+    """Safely get a cell value as a string"""
+    if field_name in column_indices and column_indices[field_name] < len(row):
+        value = row[column_indices[field_name]]
+        return str(value) if value is not None else None
+    return None
+
+
+def iter_xlsx_rows(file_path, sheet_name):
+    """Stream the rows of one sheet; read-only mode keeps the workbook on disk"""
+    workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        yield from workbook[sheet_name].iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+
+def iter_csv_rows(file_path, delimiter=None):
+    """
+    Stream the rows of a CSV/TSV file. Empty cells become None, like empty
+    Excel cells. The delimiter is guessed from the extension and header line
+    if not given.
+    """
+    # utf-8-sig also accepts the BOM Excel puts in front of UTF-8 CSV files
+    with open(file_path, newline='', encoding='utf-8-sig') as csv_file:
+        if delimiter is None:
+            if file_path.lower().endswith('.tsv'):
+                delimiter = '\t'
+            else:
+                header_line = csv_file.readline()
+                csv_file.seek(0)
+                delimiter = max([',', ';', '\t'], key=header_line.count)
+        for row in csv.reader(csv_file, delimiter=delimiter):
+            yield [cell if cell.strip() else None for cell in row]
+
+
+def iter_roster_records(rows):
+    """
+    Turn raw rows (header first) into roster records without touching the
+    database. Each record is a dict with 'row_num' and either the parsed
+    fields, 'name': None for rows without a student name, or 'error'.
+    """
+    header_row = next(rows, None)
+    if header_row is None:
+        raise ValueError("The sheet is empty")
+    column_indices = map_columns(header_row)
+
+    # Check if required columns are present
+    for required in REQUIRED_COLUMNS:
+        if required not in column_indices:
+            raise ValueError(f"Required column '{required}' not found")
+
+    # Data rows start on row 2 (row 1 is the header)
+    for row_num, row in enumerate(rows, start=2):
+        # Skip empty rows
+        if not any(cell is not None for cell in row):
+            continue
+        try:
+            student_name = _get_cell_value(row, column_indices, 'student_name')
+            teacher_name = _get_cell_value(row, column_indices, 'teacher_full_name')
+            phone_number = _get_cell_value(row, column_indices, 'phone_number')
+            yield {
+                'row_num': row_num,
+                'name': student_name.strip() if student_name and student_name.strip() else None,
+                'teacher_name': teacher_name.strip() if teacher_name else None,
+                'phone_number': phone_number.strip() if phone_number else None,
+                'is_active': parse_boolean(_get_cell_value(row, column_indices, 'is_active'), default=True),
+                'is_hidden': parse_boolean(_get_cell_value(row, column_indices, 'is_hidden'), default=False),
+            }
+        except Exception as e:
+            yield {'row_num': row_num, 'error': str(e)}
+
+
+def list_sheets(file_path):
+    """Names of all sheets in a workbook, without reading their rows"""
+    workbook = openpyxl.load_workbook(file_path, read_only=True)
+    try:
+        return workbook.sheetnames
+    finally:
+        workbook.close()
+
+
+def iter_roster_source(file_path, file_format, sheet_name=None, delimiter=None):
+    """Stream the records of one sheet or CSV/TSV file, one row at a time"""
+    if file_format == 'xlsx':
+        rows = iter_xlsx_rows(file_path, sheet_name)
+    else:
+        rows = iter_csv_rows(file_path, delimiter=delimiter)
+    return iter_roster_records(rows)
+
+
+def _spill_chunk(queue, spill, chunk):
+    """Write a chunk to the spill file, then tell the writer it is there"""
+    pickle.dump(chunk, spill)
+    spill.flush()
+    queue.put(('records', len(chunk)))
+
+
+def parse_roster_source(queue, spill_path, chunk_size, file_path, file_format, sheet_name=None, delimiter=None):
+    """
+    Parse one sheet or CSV/TSV file in a worker process. Records are pickled
+    to `spill_path` in chunks of at most `chunk_size`, and a ('records',
+    count) message on `queue` announces each chunk once it is on disk.
+
+    The worker never waits for the writer, so every source is parsed in
+    parallel while memory holds at most one chunk per worker; the parsed
+    rows wait on disk. The last message is ('done', seconds spent) or
+    ('error', exception).
+    """
+    started = time.monotonic()
+    try:
+        with open(spill_path, 'wb') as spill:
+            chunk = []
+            for record in iter_roster_source(file_path, file_format, sheet_name, delimiter):
+                chunk.append(record)
+                if len(chunk) >= chunk_size:
+                    _spill_chunk(queue, spill, chunk)
+                    chunk = []
+            if chunk:
+                _spill_chunk(queue, spill, chunk)
+    except Exception as e:
+        queue.put(('error', e))
+        return
+    queue.put(('done', time.monotonic() - started))
+
+
+def read_spilled_records(queue, spill_path, future):
+    """
+    Records of a source parsed by parse_roster_source, read back from its
+    spill file as the worker announces them; re-raises the worker's error.
+    """
+    spill = None
+    try:
+        while True:
+            try:
+                kind, value = queue.get(timeout=1)
+            except Empty:
+                # A worker that died without a last message would leave us waiting forever
+                if future.done():
+                    future.result()
+                    raise RuntimeError("parser stopped before the end of the file")
+                continue
+            if kind == 'records':
+                if spill is None:
+                    spill = open(spill_path, 'rb')
+                yield from pickle.load(spill)
+            elif kind == 'error':
+                raise value
+            else:
+                return
+    finally:
+        if spill is not None:
+            spill.close()
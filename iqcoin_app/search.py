@@ -0,0 +1,117 @@
+from django.db import connection, OperationalError
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from .search_keys import fold_search_key
+
+# FTS5 virtual table holding one row per transaction (rowid = transaction id).
+# Created by migration 0015 on SQLite only; other backends use the LIKE fallback.
+FTS_TABLE = 'iqcoin_app_transaction_fts'
+
+_fts_available = None
+
+
+def fts_available():
+    """Check once per process whether the FTS5 search table exists"""
+    global _fts_available
+    if _fts_available is None:
+        if connection.vendor != 'sqlite':
+            _fts_available = False
+        else:
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [FTS_TABLE]
+                    )
+                    _fts_available = cursor.fetchone() is not None
+            except OperationalError:
+                _fts_available = False
+    return _fts_available
+
+
+def _teacher_search_name(user):
+    """Searchable teacher text: username plus full name if there is one"""
+    try:
+        full_name = user.userprofile.full_name or ''
+    except AttributeError:
+        full_name = ''
+    return f"{user.username} {full_name}".strip()
+
+
+def index_transactions(transactions):
+    """Add or refresh the search rows of the given transactions"""
+    if not transactions or not fts_available():
+        return
+    teacher_names = {}
+    rows = []
+    for trans in transactions:
+        if trans.teacher_id not in teacher_names:
+            teacher_names[trans.teacher_id] = _teacher_search_name(trans.teacher)
+        rows.append((trans.id, trans.comment or '', trans.student.name, teacher_names[trans.teacher_id]))
+    with connection.cursor() as cursor:
+        cursor.executemany(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [(row[0],) for row in rows])
+        cursor.executemany(
+            f"INSERT INTO {FTS_TABLE} (rowid, comment, student_name, teacher_name) VALUES (%s, %s, %s, %s)",
+            rows,
+        )
+
+
+def unindex_transaction(transaction_id):
+    """Drop the search row of a deleted transaction"""
+    if not fts_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [transaction_id])
+
+
+def reindex_student(student):
+    """Refresh the student name on all search rows of this student"""
+    if not fts_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"UPDATE {FTS_TABLE} SET student_name = %s "
+            f"WHERE rowid IN (SELECT id FROM iqcoin_app_transaction WHERE student_id = %s)",
+            [student.name, student.id],
+        )
+
+
+def reindex_teacher(user):
+    """Refresh the teacher name on all search rows of this teacher"""
+    if not fts_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"UPDATE {FTS_TABLE} SET teacher_name = %s "
+            f"WHERE rowid IN (SELECT id FROM iqcoin_app_transaction WHERE teacher_id = %s)",
+            [_teacher_search_name(user), user.id],
+        )
+
+
+def _fts_query(search_query):
+    """Turn free text into an FTS5 query: every word must match as a prefix"""
+    terms = []
+    for word in search_query.split():
+        terms.append('"%s"*' % word.replace('"', '""'))
+    return ' '.join(terms)
+
+
+def filter_transactions(queryset, search_query):
+    """
+    Restrict a Transaction queryset to rows matching the search text in the
+    comment, student name or teacher name.
+    """
+    fts_query = _fts_query(search_query)
+    if not fts_query:
+        return queryset
+    if fts_available():
+        return queryset.filter(id__in=RawSQL(
+            f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s", [fts_query]
+        ))
+    # Fallback for backends without FTS5; names use their casefolded copies
+    search_key = fold_search_key(search_query)
+    return queryset.filter(
+        Q(student__name_search__contains=search_key) |
+        Q(teacher__username__icontains=search_query) |
+        Q(teacher__userprofile__full_name_search__contains=search_key) |
+        Q(comment__icontains=search_query)
+    )
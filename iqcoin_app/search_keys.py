@@ -0,0 +1,23 @@
+# Search keys for names. Nothing here touches Django, so migrations can use it.
+
+
+def fold_search_key(text):
+    """
+    Normalize a name for case-insensitive search: SQLite's LIKE only folds
+    ASCII, so names are stored and searched casefolded, with "ё" as "е".
+    """
+    if not text:
+        return ''
+    return ' '.join(text.casefold().replace('ё', 'е').split())
+
+
+def prefix_filter(field, text):
+    """
+    Lookup kwargs matching rows whose folded `field` starts with `text`.
+
+    Written as a range rather than __startswith: on SQLite that becomes a
+    LIKE, which can't use the index on a column without NOCASE collation,
+    while a range is a plain index seek on every backend.
+    """
+    key = fold_search_key(text)
+    return {f'{field}__gte': key, f'{field}__lt': key + '\U0010ffff'}
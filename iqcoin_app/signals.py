@@ -1,7 +1,15 @@
-from django.db.models.signals import post_save
+from django.core.signals import request_started
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
 from django.contrib.auth.models import User
-from .models import UserProfile, Student
+from .models import UserProfile, Student, Transaction
+from . import search
+from . import leaderboards
+from .api import invalidate_api_etags
+from .student_lookup import invalidate_student_lookup
+from .households import invalidate_households, invalidate_student_households
+from .middleware import invalidate_user_role
+from .teacher_names import invalidate_teacher_names, recheck_teacher_names
 
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
@@ -13,9 +21,9 @@ def create_user_profile(sender, instance, created, **kwargs):
             try:
                 student = Student.objects.get(id=int(instance.username.split('_')[1]))
                 # Count how many students share this phone number
-                phone_number = student.phone_number
+                phone_number = student.phone_normalized
                 if phone_number:
-                    student_count = Student.objects.filter(phone_number=phone_number, is_active=True).count()
+                    student_count = Student.objects.filter(phone_normalized=phone_number, is_active=True).count()
                     role = 'parent' if student_count > 1 else 'student'
                 else:
                     role = 'student'
@@ -34,6 +42,109 @@ def create_user_profile(sender, instance, created, **kwargs):
             UserProfile.objects.create(user=instance, role='teacher')
 
 @receiver(post_save, sender=User)
-def save_user_profile(sender, instance, **kwargs):
+def save_user_profile(sender, instance, update_fields=None, **kwargs):
+    # Logging in only touches last_login; nothing to propagate to the profile
+    if update_fields is not None and set(update_fields) == {'last_login'}:
+        return
     if hasattr(instance, 'userprofile'):
-        instance.userprofile.save()
\ No newline at end of file
+        instance.userprofile.save()
+
+@receiver(post_save, sender=Transaction)
+def index_transaction(sender, instance, **kwargs):
+    # Keep the full-text search index in step with the ledger
+    search.index_transactions([instance])
+
+@receiver(post_delete, sender=Transaction)
+def unindex_transaction(sender, instance, **kwargs):
+    search.unindex_transaction(instance.id)
+
+@receiver(post_save, sender=Student)
+def reindex_student_name(sender, instance, created, **kwargs):
+    if not created:
+        search.reindex_student(instance)
+
+@receiver(post_save, sender=UserProfile)
+def reindex_teacher_name(sender, instance, created, **kwargs):
+    if not created:
+        search.reindex_teacher(instance.user)
+
+@receiver(post_save, sender=UserProfile)
+@receiver(post_delete, sender=UserProfile)
+def invalidate_cached_role(sender, instance, **kwargs):
+    # Sessions cache the resolved role; make them resolve it again
+    invalidate_user_role(instance.user_id)
+
+@receiver(post_save, sender=User)
+@receiver(post_save, sender=UserProfile)
+@receiver(post_delete, sender=UserProfile)
+def invalidate_cached_teacher_names(sender, instance, update_fields=None, **kwargs):
+    if sender is User and update_fields is not None and set(update_fields) == {'last_login'}:
+        return
+    # Teacher display names are cached in process; make every process reload them
+    invalidate_teacher_names()
+
+@receiver(request_started)
+def recheck_cached_teacher_names(sender, **kwargs):
+    # Names are read per row; compare them with the shared version once per request
+    recheck_teacher_names()
+
+@receiver(post_save, sender=Transaction)
+@receiver(post_delete, sender=Transaction)
+def invalidate_transaction_household(sender, instance, **kwargs):
+    # The household summary lists recent transactions and balances
+    if Transaction.student.is_cached(instance):
+        invalidate_households([instance.student.phone_normalized])
+    else:
+        invalidate_student_households([instance.student_id])
+
+@receiver(pre_save, sender=Student)
+def remember_student_state(sender, instance, **kwargs):
+    # A changed phone number moves the student to another household, so the
+    # old one has to be dropped as well; the leaderboards need the old
+    # balance, teacher and visibility to tell whether anything moved
+    instance._old_phone_normalized = None
+    instance._old_ranking_state = None
+    if instance.pk and not instance._state.adding:
+        old = (
+            Student.objects.filter(pk=instance.pk)
+            .values_list('phone_normalized', 'teacher_id', 'balance', 'is_active', 'is_hidden')
+            .first()
+        )
+        if old is not None:
+            phone_normalized, teacher_id, balance, is_active, is_hidden = old
+            instance._old_phone_normalized = phone_normalized
+            instance._old_ranking_state = (teacher_id, balance, is_active and not is_hidden)
+
+@receiver(post_save, sender=Student)
+def invalidate_student_household(sender, instance, **kwargs):
+    invalidate_households([instance.phone_normalized, getattr(instance, '_old_phone_normalized', None)])
+
+@receiver(post_delete, sender=Student)
+def invalidate_deleted_student_household(sender, instance, **kwargs):
+    invalidate_households([instance.phone_normalized])
+
+@receiver(post_save, sender=Student)
+def update_student_leaderboards(sender, instance, **kwargs):
+    # Edits can change a balance, teacher or visibility; ledger writes don't
+    # save the Student and record their own changes
+    leaderboards.record_student(instance, getattr(instance, '_old_ranking_state', None))
+
+@receiver(post_delete, sender=Student)
+def remove_student_leaderboards(sender, instance, **kwargs):
+    leaderboards.remove_student(instance)
+
+@receiver(post_save, sender=Transaction)
+@receiver(post_delete, sender=Transaction)
+@receiver(post_save, sender=Student)
+@receiver(post_delete, sender=Student)
+def invalidate_api_responses(sender, instance, created=False, **kwargs):
+    # A new transaction changes the newest id the API ETags are built from;
+    # edits and deletions of existing rows need the version bumped
+    if not (sender is Transaction and created):
+        invalidate_api_etags()
+
+@receiver(post_save, sender=Student)
+@receiver(post_delete, sender=Student)
+def invalidate_student_lookup_index(sender, instance, **kwargs):
+    # The typeahead indexes hold student names and teachers
+    invalidate_student_lookup()
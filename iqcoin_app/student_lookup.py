@@ -0,0 +1,102 @@
+from bisect import bisect_left
+from uuid import uuid4
+from django.core.cache import cache
+from .models import Student
+from .search_keys import fold_search_key
+from .teacher_names import teacher_display_name
+
+# Cache key holding the current version of the lookup indexes; bumping it
+# makes every process rebuild its indexes on next use
+LOOKUP_VERSION_KEY = 'iqcoin:student_lookup_version'
+
+# In-process indexes: teacher id (None for all teachers) -> _PrefixIndex
+_indexes = {}
+_indexes_version = None
+
+
+class _PrefixIndex:
+    """Sorted (word, student id) pairs, so a prefix lookup is two bisects"""
+
+    def __init__(self, rows):
+        self.students = {}
+        words = []
+        for student_id, name, teacher_id in rows:
+            self.students[student_id] = (name, teacher_id)
+            # Every word of the name can be typed first ("Петров Иван" and "Иван")
+            for word in set(fold_search_key(name).split()):
+                words.append((word, student_id))
+        words.sort()
+        self.words = words
+        self.by_name = sorted(self.students, key=lambda student_id: self.students[student_id][0])
+
+    def _matching(self, prefix):
+        start = bisect_left(self.words, (prefix,))
+        end = bisect_left(self.words, (prefix + '\uffff',))
+        return {student_id for _, student_id in self.words[start:end]}
+
+    def search(self, query, limit, offset=0):
+        """Student ids whose name has a word starting with each word of the query, by name"""
+        parts = fold_search_key(query).split()
+        if not parts:
+            return self.by_name[offset:offset + limit]
+        matches = self._matching(parts[0])
+        for part in parts[1:]:
+            matches &= self._matching(part)
+        return sorted(matches, key=lambda student_id: self.students[student_id][0])[offset:offset + limit]
+
+
+def _current_version():
+    version = cache.get(LOOKUP_VERSION_KEY)
+    if version is None:
+        version = uuid4().hex
+        cache.set(LOOKUP_VERSION_KEY, version, None)
+    return version
+
+
+def _index(teacher_id):
+    """The index of one teacher's students (all students for None), built with one query"""
+    global _indexes, _indexes_version
+    version = _current_version()
+    if version != _indexes_version:
+        _indexes = {}
+        _indexes_version = version
+    index = _indexes.get(teacher_id)
+    if index is None:
+        # Same students the award and deduct forms accept
+        students = Student.objects.filter(is_hidden=False)
+        if teacher_id is not None:
+            students = students.filter(teacher_id=teacher_id)
+        index = _indexes[teacher_id] = _PrefixIndex(students.values_list('id', 'name', 'teacher_id').iterator())
+    return index
+
+
+def lookup(query, teacher_id=None, limit=20, offset=0):
+    """
+    Return up to `limit` students matching a typed query as dicts with id,
+    name, balance, teacher id and teacher name, ordered by name, skipping
+    the first `offset` matches.
+
+    Names come from the in-process index; balances change with every award,
+    so they are read with one query for the matches only.
+    """
+    index = _index(teacher_id)
+    student_ids = index.search(query, limit, offset)
+    balances = dict(Student.objects.filter(id__in=student_ids).values_list('id', 'balance')) if student_ids else {}
+    results = []
+    for student_id in student_ids:
+        if student_id not in balances:
+            continue
+        name, student_teacher_id = index.students[student_id]
+        results.append({
+            'id': student_id,
+            'name': name,
+            'balance': balances[student_id],
+            'teacher_id': student_teacher_id,
+            'teacher_name': teacher_display_name(student_teacher_id),
+        })
+    return results
+
+
+def invalidate_student_lookup():
+    """Drop the indexes in every process"""
+    cache.delete(LOOKUP_VERSION_KEY)
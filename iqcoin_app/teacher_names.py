@@ -0,0 +1,75 @@
+from time import monotonic
+from uuid import uuid4
+from django.contrib.auth.models import User
+from django.core.cache import cache
+
+# Cache key holding the current version of the teacher name map; bumping it
+# makes every process reload its map on next use
+NAMES_VERSION_KEY = 'iqcoin:teacher_names_version'
+
+# Seconds a process trusts its map without asking the cache for the version;
+# every request also starts with a fresh check (see recheck_teacher_names)
+NAMES_CHECK_SECONDS = 5
+
+# In-process map: user id -> display name (full name, fallback to username)
+_names = {}
+_names_version = None
+_names_checked_at = None
+
+
+def _display_name(username, full_name):
+    return full_name or username
+
+
+def _current_version():
+    version = cache.get(NAMES_VERSION_KEY)
+    if version is None:
+        version = uuid4().hex
+        cache.set(NAMES_VERSION_KEY, version, None)
+    return version
+
+
+def teacher_display_names():
+    """
+    Return the map of user id -> teacher display name.
+
+    All staff names are loaded with a single query and kept in process until
+    a User or UserProfile is saved. The shared version is read from the cache
+    once per request, not once per name looked up.
+    """
+    global _names, _names_version, _names_checked_at
+    now = monotonic()
+    if _names_checked_at is not None and now - _names_checked_at < NAMES_CHECK_SECONDS:
+        return _names
+    _names_checked_at = now
+    version = _current_version()
+    if version != _names_version:
+        # Phone-login accounts never teach, so leave them out of the bulk load
+        rows = (
+            User.objects.exclude(username__startswith='student_')
+            .values_list('id', 'username', 'userprofile__full_name')
+        )
+        _names = {user_id: _display_name(username, full_name) for user_id, username, full_name in rows}
+        _names_version = version
+    return _names
+
+
+def teacher_display_name(user_id):
+    """Return the display name of one teacher, loading it if it is not known yet"""
+    names = teacher_display_names()
+    if user_id not in names:
+        row = User.objects.filter(id=user_id).values_list('username', 'userprofile__full_name').first()
+        names[user_id] = _display_name(*row) if row else ''
+    return names[user_id]
+
+
+def recheck_teacher_names():
+    """Make the next lookup compare the map with the shared version again"""
+    global _names_checked_at
+    _names_checked_at = None
+
+
+def invalidate_teacher_names():
+    """Drop the cached names in every process"""
+    cache.delete(NAMES_VERSION_KEY)
+    recheck_teacher_names()
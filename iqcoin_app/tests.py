@@ -0,0 +1,529 @@
+import csv
+import json
+import os
+import tempfile
+from io import StringIO
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import Sum
+from django.test import Client, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from . import leaderboards, ledger
+from .models import CoinsEarned, Student, Transaction, TransactionDailyRollup, UserProfile
+
+# Query budget of every page, per role: (url name, args, query string) -> queries.
+# Budgets are for a warm request (caches filled by a first request) and must
+# not depend on how many students or transactions exist; the tests check that
+# by measuring again after multiplying the data. The session read of a
+# logged-in request is counted on top (see SESSION_QUERIES).
+COMMON_STAFF_BUDGETS = {
+    ('home', (), ''): 3,
+    ('home', (), 'search=иван'): 3,
+    ('award_coins', (), ''): 1,
+    ('deduct_coins', (), ''): 1,
+    ('transaction_history', (), ''): 3,
+    ('transaction_history', (), 'search=иван'): 3,
+    ('transaction_history', (), 'type=AWARD&student={student}'): 3,
+    ('export_transactions', (), 'format=csv'): 2,
+    ('export_transactions', (), 'format=xlsx'): 2,
+    ('student_filter_options', (), 'q=иван'): 2,
+    ('leaderboard', (), ''): 2,
+    ('leaderboard', (), 'metric=week&scope=school'): 2,
+    ('edit_transaction', ('{transaction}',), ''): 3,
+    ('student_list', (), ''): 2,
+    ('student_list', (), 'search=петров'): 2,
+    ('student_create', (), ''): 2,
+    ('student_lookup', (), 'q=ив'): 2,
+    ('student_detail', ('{student}',), ''): 3,
+    ('student_edit', ('{student}',), ''): 3,
+    ('api_students', (), ''): 3,
+    ('api_transactions', (), ''): 3,
+}
+
+BUDGETS = {
+    'anonymous': {
+        ('login', (), ''): 0,
+        ('student_login', (), ''): 0,
+        ('home', (), ''): 0,
+        ('api_students', (), ''): 0,
+        ('robots.txt', (), ''): 0,
+    },
+    'teacher': COMMON_STAFF_BUDGETS,
+    'admin': {
+        **COMMON_STAFF_BUDGETS,
+        ('analytics', (), ''): 3,
+    },
+    'student': {
+        ('home', (), ''): 1,
+        ('transaction_history', (), ''): 2,
+        ('leaderboard', (), ''): 2,
+        ('student_detail', ('{own_student}',), ''): 3,
+        ('api_students', (), ''): 3,
+        ('api_transactions', (), ''): 3,
+        ('api_household', (), ''): 2,
+    },
+    'parent': {
+        ('home', (), ''): 1,
+        ('transaction_history', (), ''): 2,
+        ('leaderboard', (), ''): 2,
+        ('api_students', (), ''): 3,
+        ('api_transactions', (), ''): 3,
+        ('api_household', (), ''): 2,
+    },
+}
+
+# Tests get a private cache and database sessions, so they never read, write
+# or clear the cache the site is configured with
+isolated_state = override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    SESSION_ENGINE='django.contrib.sessions.backends.db',
+)
+
+# Tests keep sessions in the database: one more query per logged-in request
+SESSION_QUERIES = 1
+
+STUDENT_NAMES = ['Иван Петров', 'Артём Ёжиков', 'Мария Иванова', 'Пётр Сидоров', 'Анна Смирнова']
+
+
+@isolated_state
+class QueryBudgetTests(TestCase):
+    """
+    A performance regression suite: every URL of the app is requested as
+    every role and must stay within its query budget, whatever the size of
+    the school. A template that starts reading a relation per row fails here.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = cls._create_staff('admin', 'admin', 'Администратор Школы')
+        cls.teachers = [
+            cls._create_staff('teacher1', 'teacher', 'Ёлкина Мария'),
+            cls._create_staff('teacher2', 'teacher', 'Орлов Сергей'),
+        ]
+        cls.next_phone = 9000000000
+        cls._seed(2)
+
+    @classmethod
+    def _create_staff(cls, username, role, full_name):
+        user = User.objects.create_user(username, password='password')
+        profile, _ = UserProfile.objects.get_or_create(user=user)
+        profile.role = role
+        profile.full_name = full_name
+        profile.save()
+        return user
+
+    @classmethod
+    def _seed(cls, families):
+        """
+        Add `families` households per teacher: two siblings sharing a phone
+        number (a parent login) and one student with a phone of their own,
+        each with a few awards, a deduction and an edited award.
+        """
+        for teacher in cls.teachers:
+            for _ in range(families):
+                parent_phone = f"+7{cls.next_phone}"
+                student_phone = f"8{cls.next_phone + 1}"
+                cls.next_phone += 2
+                students = [
+                    Student.objects.create(name=STUDENT_NAMES[index % len(STUDENT_NAMES)], teacher=teacher, phone_number=phone)
+                    for index, phone in enumerate([parent_phone, parent_phone, student_phone])
+                ]
+                for amount in (3, 2, 1):
+                    results = ledger.award_coins(students, amount, teacher, comment='Работа на уроке')
+                ledger.deduct_coins(students[0], 2, teacher, comment='Покупка')
+                trans = results[1].transaction
+                ledger.change_award_amount(trans, trans.amount, 3)
+                # Other teachers award these students too
+                other = cls.teachers[0] if teacher != cls.teachers[0] else cls.teachers[1]
+                ledger.award_coins(students[1:], 1, other)
+
+    def setUp(self):
+        cache.clear()
+        teacher = self.teachers[0]
+        self.student = Student.objects.filter(teacher=teacher).order_by('id').first()
+        self.transaction = Transaction.objects.filter(teacher=teacher, type='AWARD').order_by('id').first()
+        # The first student shares its phone with a sibling, the third has its own
+        self.own_student = Student.objects.filter(teacher=teacher).order_by('id')[2]
+        self.parent_phone = self.student.phone_number
+        self.student_phone = self.own_student.phone_number
+
+    def _client(self, role):
+        client = Client(HTTP_HOST='localhost')
+        if role == 'admin':
+            client.force_login(self.admin)
+        elif role == 'teacher':
+            client.force_login(self.teachers[0])
+        elif role in ['student', 'parent']:
+            phone_number = self.student_phone if role == 'student' else self.parent_phone
+            response = client.post(reverse('student_login'), {'phone_number': phone_number})
+            self.assertEqual(response.status_code, 302)
+        return client
+
+    def _url(self, name, args, query):
+        ids = {'student': self.student.id, 'own_student': self.own_student.id, 'transaction': self.transaction.id}
+        if name == 'robots.txt':
+            url = '/robots.txt'
+        else:
+            url = reverse(name, args=[arg.format(**ids) for arg in args])
+        query = query.format(**ids)
+        return f"{url}?{query}" if query else url
+
+    def _count_queries(self, client, url):
+        """Queries of a warm request to `url`, including a streamed body"""
+        client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(url)
+            if response.streaming:
+                b''.join(response.streaming_content)
+        self.assertLess(response.status_code, 500, url)
+        # Copy the SQL now: the next request resets the connection's query log
+        return len(queries), [query['sql'] for query in queries.captured_queries]
+
+    def _measure(self, role):
+        client = self._client(role)
+        counts = {}
+        for key in BUDGETS[role]:
+            url = self._url(*key)
+            counts[key] = (url,) + self._count_queries(client, url)
+        return counts
+
+    def _check_role(self, role):
+        small = self._measure(role)
+        # Triple the school and measure again: the cost must not move
+        self._seed(4)
+        cache.clear()
+        large = self._measure(role)
+
+        for key, budget in BUDGETS[role].items():
+            if role != 'anonymous':
+                budget += SESSION_QUERIES
+            url, count, queries = large[key]
+            sql = '\n'.join(queries)
+            with self.subTest(role=role, url=url):
+                self.assertLessEqual(count, budget, f"{url} as {role}: {count} queries\n{sql}")
+                self.assertEqual(count, small[key][1], f"{url} as {role} grows with the data\n{sql}")
+
+    def test_anonymous(self):
+        self._check_role('anonymous')
+
+    def test_teacher(self):
+        self._check_role('teacher')
+
+    def test_admin(self):
+        self._check_role('admin')
+
+    def test_student(self):
+        self._check_role('student')
+
+    def test_parent(self):
+        self._check_role('parent')
+
+    def test_logout(self):
+        client = self._client('parent')
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(reverse('logout'))
+        self.assertEqual(response.status_code, 302)
+        self.assertLessEqual(len(queries), 5 + SESSION_QUERIES)
+
+
+@isolated_state
+class RequestTimingTests(TestCase):
+    """RequestTimingMiddleware reports each request when REQUEST_TIMING is on"""
+
+    def setUp(self):
+        self.teacher = User.objects.create_user('teacher', password='password')
+        self.client = Client(HTTP_HOST='localhost')
+        self.client.force_login(self.teacher)
+
+    @override_settings(REQUEST_TIMING=True)
+    def test_reports_view_role_and_queries(self):
+        with self.assertLogs('iqcoin_app.requests', level='INFO') as logs:
+            response = self.client.get(reverse('student_list'))
+        self.assertIn('sql;desc="', response['Server-Timing'])
+        self.assertIn('total;dur=', response['Server-Timing'])
+        record = json.loads(logs.records[0].getMessage().split(' ', 1)[1])
+        self.assertEqual(record['view'], 'student_list')
+        self.assertEqual(record['role'], 'teacher')
+        self.assertGreater(record['queries'], 0)
+
+    @override_settings(REQUEST_TIMING=True, REQUEST_TIMING_MAX_QUERIES=0)
+    def test_warns_over_threshold(self):
+        with self.assertLogs('iqcoin_app.requests', level='WARNING') as logs:
+            self.client.get(reverse('student_list'))
+        self.assertTrue(logs.records[0].getMessage().startswith('slow request'))
+
+    def test_disabled_by_default(self):
+        response = self.client.get(reverse('student_list'))
+        self.assertNotIn('Server-Timing', response)
+
+
+@isolated_state
+class AnalyticsTests(TestCase):
+    """The daily rollup behind the analytics page stays in step with the ledger"""
+
+    def setUp(self):
+        self.admin = User.objects.create_superuser('admin', password='password')
+        profile = self.admin.userprofile
+        profile.role = 'admin'
+        profile.save()
+        self.student = Student.objects.create(name='Иван Петров', teacher=self.admin)
+        self.client = Client(HTTP_HOST='localhost')
+        self.client.force_login(self.admin)
+
+    def _rollup_totals(self):
+        return TransactionDailyRollup.objects.aggregate(count=Sum('count'), amount=Sum('amount'))
+
+    def test_impossible_dates_fall_back_to_defaults(self):
+        response = self.client.get(reverse('analytics'), {'start': '2024-02-31', 'end': '2024-02-30'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_admin_edits_and_deletes_update_rollups(self):
+        trans = ledger.award_coins([self.student], 3, self.admin)[0].transaction
+        self.client.post(reverse('admin:iqcoin_app_transaction_change', args=[trans.id]), {
+            'type': 'AWARD', 'amount': 5, 'student': self.student.id, 'teacher': self.admin.id, 'comment': '',
+        })
+        self.assertEqual(self._rollup_totals(), {'count': 1, 'amount': 5})
+        self.assertEqual(CoinsEarned.objects.get(period='week').amount, 5)
+
+        self.client.post(reverse('admin:iqcoin_app_transaction_delete', args=[trans.id]), {'post': 'yes'})
+        self.assertEqual(self._rollup_totals(), {'count': 0, 'amount': 0})
+        self.assertEqual(CoinsEarned.objects.get(period='week').amount, 0)
+
+
+@isolated_state
+class LeaderboardTests(TestCase):
+    """Ledger writes and student edits patch the loaded boards instead of rebuilding them"""
+
+    def setUp(self):
+        cache.clear()
+        leaderboards.invalidate_leaderboards()
+        self.teachers = [User.objects.create_user(f'teacher{n}', password='password') for n in (1, 2)]
+        self.students = [Student.objects.create(name=name, teacher=self.teachers[0]) for name in STUDENT_NAMES[:3]]
+        with self.captureOnCommitCallbacks(execute=True):
+            ledger.award_coins(self.students[:2], 5, self.teachers[0])
+
+    def _loaded_board(self):
+        for metric in leaderboards.METRICS:
+            leaderboards.top(metric)
+        return leaderboards._boards[('balance', None)]
+
+    def test_awards_are_patched_in(self):
+        board = self._loaded_board()
+        with self.captureOnCommitCallbacks(execute=True):
+            ledger.award_coins([self.students[2]], 7, self.teachers[0])
+        with self.assertNumQueries(0):
+            top = leaderboards.top('balance')
+            rank = leaderboards.rank('week', self.students[2].id)
+        self.assertEqual(top[0], (self.students[2].id, 7))
+        self.assertEqual(rank, (1, 7))
+        self.assertIs(self._loaded_board(), board)
+
+    def test_unrelated_edit_keeps_the_board(self):
+        board = self._loaded_board()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.students[0].name = 'Иван Петров-Водкин'
+            self.students[0].save()
+        self.assertIs(self._loaded_board(), board)
+
+    def test_teacher_change_moves_the_student(self):
+        self._loaded_board()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.students[0].teacher = self.teachers[1]
+            self.students[0].save()
+        self.assertEqual(leaderboards.top('balance', self.teachers[1].id), [(self.students[0].id, 5)])
+        self.assertEqual(leaderboards.top('week', self.teachers[1].id), [(self.students[0].id, 5)])
+        self.assertEqual(leaderboards.top('balance', self.teachers[0].id), [(self.students[1].id, 5), (self.students[2].id, 0)])
+
+    def test_hidden_students_leave_the_boards(self):
+        self._loaded_board()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.students[1].is_hidden = True
+            self.students[1].save()
+        self.assertIsNone(leaderboards.rank('balance', self.students[1].id))
+        self.assertIsNone(leaderboards.rank('month', self.students[1].id))
+
+
+@isolated_state
+class LedgerTests(TestCase):
+    """Balances and ledger rows written by the bulk and conditional ledger paths"""
+
+    def setUp(self):
+        self.teacher = User.objects.create_user('teacher', password='password')
+        self.students = [Student.objects.create(name=name, teacher=self.teacher) for name in STUDENT_NAMES[:3]]
+
+    def _balances(self):
+        return list(Student.objects.order_by('id').values_list('balance', flat=True))
+
+    def test_award_coins_moves_every_balance(self):
+        with CaptureQueriesContext(connection) as queries:
+            results = ledger.award_coins(self.students, 2, self.teacher, comment='Работа на уроке')
+        count = len(queries)
+        self.assertEqual([result.student for result in results], self.students)
+        self.assertEqual([result.balance for result in results], [2, 2, 2])
+        self.assertEqual([result.transaction.student_id for result in results], [student.id for student in self.students])
+        self.assertEqual(self._balances(), [2, 2, 2])
+        self.assertEqual(Transaction.objects.filter(type='AWARD', amount=2, comment='Работа на уроке').count(), 3)
+
+        # One batch costs the same number of queries whatever its size
+        more = [Student.objects.create(name=name, teacher=self.teacher) for name in STUDENT_NAMES]
+        with CaptureQueriesContext(connection) as queries:
+            ledger.award_coins(self.students + more, 1, self.teacher)
+        self.assertEqual(len(queries), count)
+
+    def test_deduct_coins_refuses_to_overdraw(self):
+        ledger.award_coins(self.students[:1], 3, self.teacher)
+        student = self.students[0]
+        self.assertIsNone(ledger.deduct_coins(student, 4, self.teacher))
+        self.assertEqual(self._balances()[0], 3)
+        self.assertFalse(Transaction.objects.filter(type='DEDUCT').exists())
+
+        trans = ledger.deduct_coins(student, 3, self.teacher, comment='Покупка')
+        self.assertEqual((trans.type, trans.amount, trans.comment), ('DEDUCT', 3, 'Покупка'))
+        self.assertEqual(student.balance, 0)
+        self.assertEqual(self._balances()[0], 0)
+
+    def test_change_award_amount(self):
+        trans = ledger.award_coins(self.students[:1], 3, self.teacher)[0].transaction
+        self.assertEqual(ledger.change_award_amount(trans, 3, 1), -2)
+        trans.refresh_from_db()
+        self.assertEqual((trans.amount, trans.edited), (1, True))
+        self.assertEqual(self._balances()[0], 1)
+
+        self.assertEqual(ledger.change_award_amount(trans, 1, 3), 2)
+        self.assertEqual(self._balances()[0], 3)
+
+        # The coins were spent: lowering the award again is refused
+        ledger.deduct_coins(self.students[0], 3, self.teacher)
+        self.assertIsNone(ledger.change_award_amount(trans, 3, 1))
+        self.assertEqual(trans.amount, 3)
+        trans.refresh_from_db()
+        self.assertEqual(trans.amount, 3)
+        self.assertEqual(self._balances()[0], 0)
+
+
+@isolated_state
+class RosterImportTests(TestCase):
+    """import_students_excel only writes rows whose content changed since the last import"""
+
+    def setUp(self):
+        teacher = User.objects.create_user('teacher', password='password')
+        profile = teacher.userprofile
+        profile.role = 'teacher'
+        profile.full_name = 'Орлов Сергей'
+        profile.save()
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.rows = [
+            ['Иван Петров', 'Орлов Сергей', '+79000000001'],
+            ['Мария Иванова', 'Орлов Сергей', '89000000002'],
+            ['Пётр Сидоров', 'Орлов Сергей', ''],
+        ]
+
+    def _import(self, *args, rows=None, name='roster.csv'):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'w', newline='', encoding='utf-8') as roster:
+            writer = csv.writer(roster)
+            writer.writerow(['student_name', 'teacher_full_name', 'phone_number'])
+            writer.writerows(self.rows if rows is None else rows)
+        output = StringIO()
+        call_command('import_students_excel', '--file', path, '--workers', '1', *args, stdout=output, no_color=True)
+        return output.getvalue()
+
+    def _students(self):
+        return list(Student.objects.order_by('id').values_list('id', 'name', 'phone_number', 'is_active'))
+
+    def test_rerun_leaves_rows_unchanged(self):
+        self.assertIn('Created: 3, Updated: 0, Unchanged: 0', self._import())
+        students = self._students()
+        self.assertIn('Created: 0, Updated: 0, Unchanged: 3', self._import())
+        self.assertEqual(self._students(), students)
+        # --full compares every row with the database, and still finds nothing to write
+        self.assertIn('Created: 0, Updated: 0, Unchanged: 3', self._import('--full'))
+
+    def test_changed_and_removed_rows(self):
+        self._import()
+        self.rows[0][2] = '+79000000009'
+        output = self._import('--deactivate-removed', rows=self.rows[:2])
+        self.assertIn('Created: 0, Updated: 1, Unchanged: 1, Removed: 1', output)
+        self.assertEqual(
+            [(name, phone, active) for _, name, phone, active in self._students()],
+            [('Иван Петров', '+79000000009', True), ('Мария Иванова', '89000000002', True), ('Пётр Сидоров', None, False)],
+        )
+
+    def test_failed_source_is_an_error(self):
+        output = StringIO()
+        call_command('import_students_excel', '--file', os.path.join(self.directory.name, 'missing.csv'),
+                     '--workers', '1', stdout=output, no_color=True)
+        self.assertIn('Failed sources: 1', output.getvalue())
+        self.assertIn('Errors: 1', output.getvalue())
+
+
+@isolated_state
+class ReconcileBalancesTests(TestCase):
+    """reconcile_balances reports drift, and fixes it in batches with --fix"""
+
+    def setUp(self):
+        teacher = User.objects.create_user('teacher', password='password')
+        self.students = [Student.objects.create(name=name, teacher=teacher) for name in STUDENT_NAMES]
+        ledger.award_coins(self.students, 3, teacher)
+        ledger.deduct_coins(self.students[0], 1, teacher)
+        # Drift two balances behind the ledger's back
+        Student.objects.filter(id__in=[self.students[0].id, self.students[3].id]).update(balance=10)
+
+    def _reconcile(self, *args):
+        output = StringIO()
+        call_command('reconcile_balances', *args, stdout=output, no_color=True)
+        return output.getvalue()
+
+    def _balances(self):
+        return list(Student.objects.order_by('id').values_list('balance', flat=True))
+
+    def test_reports_without_fixing(self):
+        output = self._reconcile()
+        self.assertIn('Checked: 5, Drifted: 2', output)
+        self.assertEqual(self._balances(), [10, 3, 3, 10, 3])
+
+    def test_fix_in_batches(self):
+        output = self._reconcile('--fix', '--batch-size', '1')
+        self.assertIn('Checked: 5, Drifted: 2, Fixed: 2', output)
+        self.assertEqual(self._balances(), [2, 3, 3, 3, 3])
+        self.assertIn('Drifted: 0', self._reconcile())
+
+
+@isolated_state
+class PhoneLoginTests(TestCase):
+    """Every way of writing a phone number logs in to the same household"""
+
+    def setUp(self):
+        teacher = User.objects.create_user('teacher', password='password')
+        # Siblings stored with differently written numbers, and an inactive student
+        self.siblings = [
+            Student.objects.create(name='Иван Петров', teacher=teacher, phone_number='+7 (900) 123-45-67'),
+            Student.objects.create(name='Мария Петрова', teacher=teacher, phone_number='89001234567'),
+        ]
+        Student.objects.create(name='Пётр Петров', teacher=teacher, phone_number='+79001234567', is_active=False)
+
+    def _login(self, phone_number):
+        client = Client(HTTP_HOST='localhost')
+        response = client.post(reverse('student_login'), {'phone_number': phone_number})
+        return client, response
+
+    def test_formats_log_in_to_the_same_students(self):
+        for phone_number in ('+79001234567', '89001234567', '8 (900) 123-45-67', '9001234567'):
+            with self.subTest(phone_number=phone_number):
+                client, response = self._login(phone_number)
+                self.assertRedirects(response, reverse('home'), fetch_redirect_response=False)
+                self.assertEqual(client.session['student_phone_number'], '79001234567')
+                profile = User.objects.get(username=f'student_{self.siblings[0].id}').userprofile
+                self.assertEqual((profile.role, profile.student_id), ('parent', self.siblings[0].id))
+                data = client.get(reverse('api_household')).json()
+                self.assertEqual(sorted(student['name'] for student in data['students']), ['Иван Петров', 'Мария Петрова'])
+        self.assertEqual(User.objects.filter(username__startswith='student_').count(), 1)
+
+    def test_unknown_number(self):
+        client, response = self._login('+79009999999')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('_auth_user_id', client.session)
@@ -1,6 +1,6 @@
 from django.urls import path
 from django.views.generic import TemplateView
-from . import views
+from . import views, api
 
 urlpatterns = [
     path('', views.home, name='home'),
@@ -11,12 +11,21 @@ urlpatterns = [
     path('award-coins/', views.award_coins, name='award_coins'),
     path('deduct-coins/', views.deduct_coins, name='deduct_coins'),
     path('transaction-history/', views.transaction_history, name='transaction_history'),
+    path('transaction-history/export/', views.export_transactions, name='export_transactions'),
+    path('transaction-history/students/', views.student_filter_options, name='student_filter_options'),
+    path('leaderboard/', views.leaderboard, name='leaderboard'),
+    path('analytics/', views.analytics_view, name='analytics'),
     path('edit-transaction/<int:transaction_id>/', views.edit_transaction, name='edit_transaction'),
     # Student management URLs
     path('students/', views.student_list, name='student_list'),
     path('students/create/', views.student_create, name='student_create'),
+    path('students/lookup/', views.student_lookup, name='student_lookup'),
     path('students/<int:student_id>/', views.student_detail, name='student_detail'),
     path('students/<int:student_id>/edit/', views.student_edit, name='student_edit'),
+    # Read-only JSON API
+    path('api/students/', api.students, name='api_students'),
+    path('api/transactions/', api.transactions, name='api_transactions'),
+    path('api/household/', api.household, name='api_household'),
     # Robots.txt handler
     path('robots.txt', TemplateView.as_view(template_name='robots.txt', content_type='text/plain')),
 ]
\ No newline at end of file
@@ -1,15 +1,23 @@
+from datetime import timedelta
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.models import User
 from django.contrib import messages
 from django.db.models import Q
-from django.db import transaction as db_transaction
-from django.http import HttpResponseForbidden, HttpResponse
+from django.http import HttpResponseForbidden, JsonResponse, StreamingHttpResponse, FileResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_date
 from django.views.decorators.csrf import csrf_protect
+from django.conf import settings
 from .models import Student, Transaction, UserProfile
 from .forms import AwardCoinsForm, DeductCoinsForm, EditTransactionForm, StudentForm, StudentEditForm
-from .decorators import student_required, teacher_required, admin_required, teacher_or_admin_required, role_required
+from .decorators import admin_required, teacher_or_admin_required
+from . import ledger, leaderboards, analytics, exports
+from .pagination import keyset_page, name_page
+from .queries import filtered_transactions
+from .search_keys import fold_search_key, prefix_filter
+from .student_lookup import lookup as lookup_students
 import logging
 
 # Get logger instance
@@ -22,30 +30,9 @@ def user_login(request):
         user = authenticate(request, username=username, password=password)
         if user is not None:
             login(request, user)
-            # Check user role and redirect accordingly
-            try:
-                user_profile = user.userprofile
-            except UserProfile.DoesNotExist:
-                # Create a default profile if it doesn't exist
-                # But don't assume it's a teacher - let's check if it's linked to a student
-                if hasattr(user, 'student_set') and user.student_set.exists():
-                    # This user is linked to a student, so they should be a student or parent
-                    student_count = user.student_set.count()
-                    role = 'parent' if student_count > 1 else 'student'
-                    user_profile = UserProfile.objects.create(user=user, role=role)
-                else:
-                    # Default to teacher for staff/admin users
-                    user_profile = UserProfile.objects.create(user=user, role='teacher')
-            
-            # Redirect based on role
-            if user_profile.role == 'student':
-                return redirect('home')  # Will show student home
-            elif user_profile.role == 'teacher':
-                return redirect('home')  # Will show teacher home
-            elif user_profile.role == 'admin':
-                return redirect('home')  # Will show admin home
-            else:
-                return redirect('home')  # Default home
+            # The role is resolved by RoleMiddleware on the next request;
+            # every role lands on its own variant of the home page
+            return redirect('home')
         else:
             messages.error(request, 'Invalid username or password.')
     return render(request, 'login.html')
@@ -91,70 +78,29 @@ def custom_logout(request):
 
 @login_required
 def home(request):
-    # Get user profile
-    try:
-        user_profile = request.user.userprofile
-    except UserProfile.DoesNotExist:
-        # Check if this is a student user account (created by the StudentPhoneBackend)
-        if request.user.username.startswith('student_'):
-            # This is a student user account
-            # Determine if it's a parent (multiple students with same phone) or student
-            try:
-                student = Student.objects.get(id=int(request.user.username.split('_')[1]))
-                # Count how many students share this phone number
-                phone_number = student.phone_number
-                if phone_number:
-                    student_count = Student.objects.filter(phone_number=phone_number, is_active=True).count()
-                    role = 'parent' if student_count > 1 else 'student'
-                else:
-                    role = 'student'
-                user_profile = UserProfile.objects.create(user=request.user, role=role, student=student)
-                # Store the phone number in the session
-                request.session['student_phone_number'] = phone_number
-            except (ValueError, Student.DoesNotExist):
-                # Fallback to student role if we can't determine
-                user_profile = UserProfile.objects.create(user=request.user, role='student')
-        # But don't assume it's a teacher - let's check if it's linked to a student
-        elif hasattr(request.user, 'student_set') and request.user.student_set.exists():
-            # This user is linked to a student, so they should be a student or parent
-            student_count = request.user.student_set.count()
-            role = 'parent' if student_count > 1 else 'student'
-            user_profile = UserProfile.objects.create(user=request.user, role=role)
-        else:
-            # Default to teacher for staff/admin users
-            user_profile = UserProfile.objects.create(user=request.user, role='teacher')
+    role = request.iq_role
     
     # Check if this is a student or parent
-    if user_profile.role in ['student', 'parent']:
+    if role in ['student', 'parent']:
         # Get the phone number from session (set during login)
         phone_number = request.session.get('student_phone_number')
         
         if phone_number:
-            # Get all students with this phone number
-            students_with_phone = Student.objects.filter(
-                phone_number=phone_number,
-                is_active=True
-            ).order_by('name')
-            
-            # Calculate total balance for parents
-            total_balance = sum(student.balance for student in students_with_phone)
-            
-            # Get all transactions for these students
-            recent_transactions = Transaction.objects.filter(
-                student__in=students_with_phone
-            ).order_by('-date')[:10]
-            
+            # Students, total balance and recent transactions of everyone
+            # sharing this phone number, cached until one of them changes
+            household = request.iq_household
+
             context = {
-                'students': students_with_phone,
-                'recent_transactions': recent_transactions,
+                'students': household['students'],
+                'recent_transactions': household['recent_transactions'],
                 'phone_number': phone_number,
-                'is_parent': user_profile.role == 'parent',
-                'total_balance': total_balance,
+                'is_parent': role == 'parent',
+                'total_balance': household['total_balance'],
             }
             return render(request, 'student_home.html', context)
     
     # For teachers and admins, show the dashboard with only non-hidden students
-    if user_profile.role == 'teacher':
+    if role == 'teacher':
         # Teachers see only their own non-hidden students
         students = Student.objects.filter(
             teacher=request.user,
@@ -165,14 +111,15 @@ def home(request):
         # Add search functionality for teachers
         search_query = request.GET.get('search')
         if search_query:
+            # Folded column: SQLite's icontains only ignores case for ASCII
             students = students.filter(
-                Q(name__icontains=search_query)
+                Q(name_search__contains=fold_search_key(search_query))
             )
         
         # Get recent transactions for this teacher
         recent_transactions = Transaction.objects.filter(
             teacher=request.user
-        ).order_by('-date')[:10]
+        ).select_related('student').order_by('-date')[:10]
         
         context = {
             'students': students,
@@ -181,7 +128,7 @@ def home(request):
         }
         return render(request, 'teacher_home.html', context)
     
-    elif user_profile.role == 'admin':
+    elif role == 'admin':
         # Admins see all non-hidden students
         students = Student.objects.filter(
             is_hidden=False,
@@ -191,14 +138,15 @@ def home(request):
         # Add search functionality for admins
         search_query = request.GET.get('search')
         if search_query:
+            search_key = fold_search_key(search_query)
             students = students.filter(
-                Q(name__icontains=search_query) |
+                Q(name_search__contains=search_key) |
                 Q(teacher__username__icontains=search_query) |
-                Q(teacher__userprofile__full_name__icontains=search_query)
+                Q(teacher__userprofile__full_name_search__contains=search_key)
             )
         
         # Get all recent transactions
-        recent_transactions = Transaction.objects.all().order_by('-date')[:10]
+        recent_transactions = Transaction.objects.select_related('student').order_by('-date')[:10]
         
         context = {
             'students': students,
@@ -210,257 +158,190 @@ def home(request):
     # Default fallback
     return render(request, 'home.html')
 
+def _selected_students(form, field_name):
+    """Students already picked in a submitted form, to show them again after an error"""
+    if not form.is_bound:
+        return Student.objects.none()
+    value = form[field_name].value() or []
+    if not isinstance(value, list):
+        value = [value]
+    student_ids = [student_id for student_id in value if str(student_id).isdigit()]
+    return form.fields[field_name].queryset.filter(id__in=student_ids)
+
+@teacher_or_admin_required
+def student_lookup(request):
+    """
+    Typeahead search for the award and deduct pages: students whose name
+    starts with the typed words, limited to the caller's own students for
+    teachers. `next` is the ?offset= of the following page, or None.
+    """
+    teacher_id = None if request.iq_role == 'admin' else request.user.id
+    try:
+        limit = min(int(request.GET.get('limit', 20)), 100)
+        offset = max(int(request.GET.get('offset', 0)), 0)
+    except ValueError:
+        limit, offset = 20, 0
+    # One extra match tells whether there is a next page
+    results = lookup_students(request.GET.get('q', ''), teacher_id=teacher_id, limit=limit + 1, offset=offset)
+    next_offset = offset + limit if len(results) > limit else None
+    return JsonResponse({'results': results[:limit], 'next': next_offset})
+
 @login_required
 def award_coins(request):
-    # Get user profile
-    try:
-        user_profile = request.user.userprofile
-    except UserProfile.DoesNotExist:
-        # Check if this is a student user account (created by the StudentPhoneBackend)
-        if request.user.username.startswith('student_'):
-            # This is a student user account
-            # Determine if it's a parent (multiple students with same phone) or student
-            try:
-                student = Student.objects.get(id=int(request.user.username.split('_')[1]))
-                # Count how many students share this phone number
-                phone_number = student.phone_number
-                if phone_number:
-                    student_count = Student.objects.filter(phone_number=phone_number, is_active=True).count()
-                    role = 'parent' if student_count > 1 else 'student'
-                else:
-                    role = 'student'
-                user_profile = UserProfile.objects.create(user=request.user, role=role, student=student)
-            except (ValueError, Student.DoesNotExist):
-                # Fallback to student role if we can't determine
-                user_profile = UserProfile.objects.create(user=request.user, role='student')
-        # But don't assume it's a teacher - let's check if it's linked to a student
-        elif hasattr(request.user, 'student_set') and request.user.student_set.exists():
-            # This user is linked to a student, so they should be a student or parent
-            student_count = request.user.student_set.count()
-            role = 'parent' if student_count > 1 else 'student'
-            user_profile = UserProfile.objects.create(user=request.user, role=role)
-        else:
-            # Default to teacher for staff/admin users
-            user_profile = UserProfile.objects.create(user=request.user, role='teacher')
+    role = request.iq_role
     
     # Only teachers and admins can award coins
-    if user_profile.role not in ['teacher', 'admin']:
-        if user_profile.role == 'parent':
+    if role not in ['teacher', 'admin']:
+        if role == 'parent':
             return HttpResponseForbidden("Parents cannot award coins. Please contact a teacher or administrator.")
         return HttpResponseForbidden("Only teachers and admins can award coins.")
     
     if request.method == 'POST':
-        form = AwardCoinsForm(request.POST, user=request.user)
+        form = AwardCoinsForm(request.POST, user=request.user, role=request.iq_role)
         if form.is_valid():
             students = form.cleaned_data['students']
             amount = form.cleaned_data['amount']
             
-            with db_transaction.atomic():
-                for student in students:
-                    # Create transaction record
-                    Transaction.objects.create(
-                        type='AWARD',
-                        amount=amount,
-                        student=student,
-                        teacher=request.user
-                    )
-                    # Update student balance
-                    student.balance += amount
-                    student.save()
+            # Award everyone with one bulk insert and one balance update
+            results = ledger.award_coins(students, amount, request.user)
             
-            messages.success(request, f'Successfully awarded {amount} IQ-coins to {students.count()} students.')
+            messages.success(request, f'Successfully awarded {amount} IQ-coins to {len(results)} students.')
             return redirect('home')
     else:
-        form = AwardCoinsForm(user=request.user)
+        form = AwardCoinsForm(user=request.user, role=request.iq_role)
     
-    return render(request, 'award_coins.html', {'form': form})
+    # Students are looked up with student_lookup as the user types
+    context = {
+        'form': form,
+        'selected_students': _selected_students(form, 'students'),
+    }
+    return render(request, 'award_coins.html', context)
 
 @login_required
 def deduct_coins(request):
-    # Get user profile
-    try:
-        user_profile = request.user.userprofile
-    except UserProfile.DoesNotExist:
-        # Create a default profile if it doesn't exist
-        # But don't assume it's a teacher - let's check if it's linked to a student
-        if hasattr(request.user, 'student_set') and request.user.student_set.exists():
-            # This user is linked to a student, so they should be a student or parent
-            student_count = request.user.student_set.count()
-            role = 'parent' if student_count > 1 else 'student'
-            user_profile = UserProfile.objects.create(user=request.user, role=role)
-        else:
-            # Default to teacher for staff/admin users
-            user_profile = UserProfile.objects.create(user=request.user, role='teacher')
+    role = request.iq_role
     
     # Only teachers and admins can deduct coins
-    if user_profile.role not in ['teacher', 'admin']:
-        if user_profile.role == 'parent':
+    if role not in ['teacher', 'admin']:
+        if role == 'parent':
             return HttpResponseForbidden("Parents cannot deduct coins. Please contact a teacher or administrator.")
         return HttpResponseForbidden("Only teachers and admins can deduct coins.")
     
     if request.method == 'POST':
-        form = DeductCoinsForm(request.POST, user=request.user)
+        form = DeductCoinsForm(request.POST, user=request.user, role=request.iq_role)
         if form.is_valid():
             student = form.cleaned_data['student']
             amount = form.cleaned_data['amount']
             comment = form.cleaned_data['comment']
             
-            if student.balance >= amount:
-                with db_transaction.atomic():
-                    # Create transaction record
-                    Transaction.objects.create(
-                        type='DEDUCT',
-                        amount=amount,
-                        student=student,
-                        teacher=request.user,
-                        comment=comment
-                    )
-                    # Update student balance
-                    student.balance -= amount
-                    student.save()
-                
+            # Check and decrement the balance in a single conditional UPDATE
+            if ledger.deduct_coins(student, amount, request.user, comment=comment):
                 messages.success(request, f'Successfully deducted {amount} IQ-coins from {student.name}.')
                 return redirect('home')
             else:
+                student.refresh_from_db(fields=['balance'])
                 messages.error(request, f'{student.name} has insufficient balance. Current balance: {student.balance}')
     else:
-        form = DeductCoinsForm(user=request.user)
-    
-    # Get students for the searchable dropdown
-    try:
-        user_profile = request.user.userprofile
-        if user_profile.role == 'admin':
-            # Admins can deduct coins from all students
-            students = Student.objects.filter(is_hidden=False).select_related('teacher__userprofile').order_by('name')
-        else:
-            # Teachers can only deduct coins from their own students
-            students = Student.objects.filter(teacher=request.user, is_hidden=False).order_by('name')
-    except:
-        # Default: only show students from classes taught by the current teacher
-        students = Student.objects.filter(teacher=request.user, is_hidden=False).order_by('name')
-    
-    # Convert students to JSON-compatible format for JavaScript
-    students_data = []
-    for student in students:
-        # Try to get the teacher's full name, fallback to username
-        if student.teacher:
-            if hasattr(student.teacher, 'userprofile') and student.teacher.userprofile.full_name:
-                teacher_name = student.teacher.userprofile.full_name
-            else:
-                teacher_name = student.teacher.username
-        else:
-            teacher_name = "No Teacher"
-            
-        students_data.append({
-            'id': student.id,
-            'full_name': student.name,
-            'balance': student.balance,
-            'teacher_name': teacher_name
-        })
+        form = DeductCoinsForm(user=request.user, role=request.iq_role)
     
-    import json
-    students_json = json.dumps(students_data)
-    
-    return render(request, 'deduct_coins.html', {'form': form, 'students_json': students_json})
+    # Students are looked up with student_lookup as the user types
+    context = {
+        'form': form,
+        'selected_student': _selected_students(form, 'student').first(),
+    }
+    return render(request, 'deduct_coins.html', context)
+
+def _history_page_url(request, **cursor):
+    """Build a history page link that keeps the current filters"""
+    params = request.GET.copy()
+    params.pop('after', None)
+    params.pop('before', None)
+    params.update(cursor)
+    return f"?{params.urlencode()}"
+
+def _filter_students(request):
+    """Students offered by the history's student filter: a teacher's own class, or everyone for admins"""
+    if request.iq_role == 'admin':
+        return Student.objects.all()
+    return Student.objects.filter(teacher=request.user)
+
+@teacher_or_admin_required
+def student_filter_options(request):
+    """
+    One page of the history's student filter, by name, optionally narrowed
+    to names starting with ?q=; follow `next` with ?after=.
+    """
+    students = _filter_students(request).only('id', 'name')
+    search_query = request.GET.get('q', '').strip()
+    if search_query:
+        # Prefix match: an index seek on the folded name, unlike __contains
+        students = students.filter(**prefix_filter('name_search', search_query))
+    items, next_cursor = name_page(students, settings.STUDENT_FILTER_PAGE_SIZE, after=request.GET.get('after'))
+    return JsonResponse({
+        'results': [{'id': student.id, 'name': student.name} for student in items],
+        'next': next_cursor,
+    })
 
 @login_required
 def transaction_history(request):
-    # Get user profile
-    try:
-        user_profile = request.user.userprofile
-    except UserProfile.DoesNotExist:
-        # Check if this is a student user account (created by the StudentPhoneBackend)
-        if request.user.username.startswith('student_'):
-            # This is a student user account
-            # Determine if it's a parent (multiple students with same phone) or student
-            try:
-                student = Student.objects.get(id=int(request.user.username.split('_')[1]))
-                # Count how many students share this phone number
-                phone_number = student.phone_number
-                if phone_number:
-                    student_count = Student.objects.filter(phone_number=phone_number, is_active=True).count()
-                    role = 'parent' if student_count > 1 else 'student'
-                else:
-                    role = 'student'
-                user_profile = UserProfile.objects.create(user=request.user, role=role, student=student)
-            except (ValueError, Student.DoesNotExist):
-                # Fallback to student role if we can't determine
-                user_profile = UserProfile.objects.create(user=request.user, role='student')
-        # But don't assume it's a teacher - let's check if it's linked to a student
-        elif hasattr(request.user, 'student_set') and request.user.student_set.exists():
-            # This user is linked to a student, so they should be a student or parent
-            student_count = request.user.student_set.count()
-            role = 'parent' if student_count > 1 else 'student'
-            user_profile = UserProfile.objects.create(user=request.user, role=role)
-        else:
-            # Default to teacher for staff/admin users
-            user_profile = UserProfile.objects.create(user=request.user, role='teacher')
-    
-    # Role-based access
-    if user_profile.role in ['student', 'parent']:
-        # Students and parents can see transactions for all students with their phone number
-        phone_number = request.session.get('student_phone_number')
-        
-        # If phone number is not in session, try to get it from the student profile
-        if not phone_number and user_profile.student:
-            phone_number = user_profile.student.phone_number
-            # Store it in session for future use
-            if phone_number:
-                request.session['student_phone_number'] = phone_number
-        
-        if phone_number:
-            # Get all students with this phone number (both active and inactive to ensure we catch all transactions)
-            students_with_phone = Student.objects.filter(
-                phone_number=phone_number
-            )
-            transactions = Transaction.objects.filter(student__in=students_with_phone).order_by('-date')
-        else:
-            # Fallback to just their own transactions
-            transactions = Transaction.objects.filter(student=user_profile.student).order_by('-date') if user_profile.student else Transaction.objects.none()
-    elif user_profile.role == 'teacher':
-        # Teachers can only see transactions they made
-        transactions = Transaction.objects.filter(teacher=request.user).order_by('-date')
-    elif user_profile.role == 'admin':
-        # Admins can see all transactions
-        transactions = Transaction.objects.all().order_by('-date')
-    else:
-        # Default: teachers can only see transactions they made
-        transactions = Transaction.objects.filter(teacher=request.user).order_by('-date')
-    
-    # Filter by student if specified (only for teachers and admins)
+    role = request.iq_role
+    transactions = filtered_transactions(request)
     student_filter = request.GET.get('student')
-    if student_filter and user_profile.role in ['teacher', 'admin']:
-        transactions = transactions.filter(student_id=student_filter)
-    
-    # Filter by transaction type if specified
     type_filter = request.GET.get('type')
-    if type_filter:
-        transactions = transactions.filter(type=type_filter)
-    
-    # Search functionality (only for teachers and admins)
     search_query = request.GET.get('search')
-    if search_query and user_profile.role in ['teacher', 'admin']:
-        transactions = transactions.filter(
-            Q(student__name__icontains=search_query) |
-            Q(teacher__username__icontains=search_query) |
-            Q(comment__icontains=search_query)
-        )
-    
-    # Get students for filter dropdown (only for teachers and admins)
-    if user_profile.role in ['teacher', 'admin']:
-        students = Student.objects.all().order_by('name')
-    else:
-        students = Student.objects.none()
+    
+    # Student filter (only for teachers and admins): rendered inline when the
+    # caller's students fit in one page, otherwise loaded from student_filter_options
+    students = []
+    students_lazy = False
+    selected_student = None
+    if role in ['teacher', 'admin']:
+        students, more = name_page(_filter_students(request).only('id', 'name'), settings.STUDENT_FILTER_PAGE_SIZE)
+        if more:
+            students_lazy = True
+            students = []
+            if student_filter and student_filter.isdigit():
+                selected_student = _filter_students(request).only('id', 'name').filter(id=student_filter).first()
+    
+    # Keyset pagination on (date, id): every page is a range seek, not an OFFSET
+    page = keyset_page(
+        transactions.select_related('student'),
+        settings.TRANSACTION_HISTORY_PAGE_SIZE,
+        after=request.GET.get('after'),
+        before=request.GET.get('before'),
+    )
     
     context = {
-        'transactions': transactions,
+        'transactions': page.items,
+        'newer_url': _history_page_url(request, before=page.newer_cursor) if page.newer_cursor else None,
+        'older_url': _history_page_url(request, after=page.older_cursor) if page.older_cursor else None,
+        'export_query': _history_page_url(request),
         'students': students,
+        'students_lazy': students_lazy,
+        'selected_student': selected_student,
         'current_student': student_filter,
         'current_type': type_filter,
         'search_query': search_query,
     }
     return render(request, 'transaction_history.html', context)
 
+@login_required
+def export_transactions(request):
+    """
+    Download the transaction history with the same filters as the history page,
+    as CSV (streamed) or XLSX (?format=xlsx, built in a temporary file first).
+    """
+    transactions = filtered_transactions(request)
+    filename = f"transactions_{timezone.localdate():%Y%m%d}"
+    
+    if request.GET.get('format') == 'xlsx':
+        return FileResponse(exports.write_xlsx(transactions), as_attachment=True, filename=f"{filename}.xlsx")
+    
+    # Rows are sent as they are read, so the download starts at once
+    response = StreamingHttpResponse(exports.stream_csv(transactions), content_type='text/csv; charset=utf-8')
+    response['Content-Disposition'] = f'attachment; filename="{filename}.csv"'
+    return response
+
 @login_required
 def edit_transaction(request, transaction_id):
     trans = get_object_or_404(Transaction, id=transaction_id)
@@ -471,24 +352,18 @@ def edit_transaction(request, transaction_id):
         return redirect('transaction_history')
     
     if request.method == 'POST':
+        # Remember the stored amount: validating the form overwrites trans.amount
+        old_amount = trans.amount
         form = EditTransactionForm(request.POST, instance=trans)
         if form.is_valid():
-            old_amount = trans.amount
             new_amount = form.cleaned_data['amount']
             
-            with db_transaction.atomic():
-                # Update student balance
-                difference = new_amount - old_amount
-                trans.student.balance += difference
-                trans.student.save()
-                
-                # Save transaction with edited flag
-                trans.amount = new_amount
-                trans.edited = True
-                trans.save()
-            
-            messages.success(request, f'Transaction updated successfully. Balance adjusted by {difference} coins.')
-            return redirect('transaction_history')
+            # Adjust the balance and the transaction together, never below zero
+            difference = ledger.change_award_amount(trans, old_amount, new_amount)
+            if difference is not None:
+                messages.success(request, f'Transaction updated successfully. Balance adjusted by {difference} coins.')
+                return redirect('transaction_history')
+            messages.error(request, f'{trans.student.name} has already spent these coins. The award cannot be lowered to {new_amount}.')
     else:
         form = EditTransactionForm(instance=trans)
     
@@ -496,45 +371,16 @@ def edit_transaction(request, transaction_id):
 
 @login_required
 def student_list(request):
-    # Get user profile
-    try:
-        user_profile = request.user.userprofile
-    except UserProfile.DoesNotExist:
-        # Check if this is a student user account (created by the StudentPhoneBackend)
-        if request.user.username.startswith('student_'):
-            # This is a student user account
-            # Determine if it's a parent (multiple students with same phone) or student
-            try:
-                student = Student.objects.get(id=int(request.user.username.split('_')[1]))
-                # Count how many students share this phone number
-                phone_number = student.phone_number
-                if phone_number:
-                    student_count = Student.objects.filter(phone_number=phone_number, is_active=True).count()
-                    role = 'parent' if student_count > 1 else 'student'
-                else:
-                    role = 'student'
-                user_profile = UserProfile.objects.create(user=request.user, role=role, student=student)
-            except (ValueError, Student.DoesNotExist):
-                # Fallback to student role if we can't determine
-                user_profile = UserProfile.objects.create(user=request.user, role='student')
-        # But don't assume it's a teacher - let's check if it's linked to a student
-        elif hasattr(request.user, 'student_set') and request.user.student_set.exists():
-            # This user is linked to a student, so they should be a student or parent
-            student_count = request.user.student_set.count()
-            role = 'parent' if student_count > 1 else 'student'
-            user_profile = UserProfile.objects.create(user=request.user, role=role)
-        else:
-            # Default to teacher for staff/admin users
-            user_profile = UserProfile.objects.create(user=request.user, role='teacher')
+    role = request.iq_role
     
     # Role-based access
-    if user_profile.role == 'student':
+    if role == 'student':
         # Students can only see themselves
-        students = Student.objects.filter(id=user_profile.student.id) if user_profile.student else Student.objects.none()
-    elif user_profile.role == 'teacher':
+        students = request.iq_students
+    elif role == 'teacher':
         # Teachers can see all their students (including hidden and inactive - this is the management page)
         students = Student.objects.filter(teacher=request.user).order_by('name')
-    elif user_profile.role == 'admin':
+    elif role == 'admin':
         # Admins can see all students (including hidden and inactive - this is the management page)
         students = Student.objects.all().order_by('teacher__username', 'name')
     else:
@@ -544,18 +390,20 @@ def student_list(request):
     # Get search query
     search_query = request.GET.get('search')
     if search_query:
+        # Names are matched on their casefolded copies (Cyrillic-safe)
+        search_key = fold_search_key(search_query)
         # Enhanced search for administrator - include phone number and teacher name
-        if user_profile.role == 'admin':
+        if role == 'admin':
             students = students.filter(
-                Q(name__icontains=search_query) |
+                Q(name_search__contains=search_key) |
                 Q(phone_number__icontains=search_query) |
                 Q(teacher__username__icontains=search_query) |
-                Q(teacher__userprofile__full_name__icontains=search_query)
+                Q(teacher__userprofile__full_name_search__contains=search_key)
             )
         else:
             # Regular search for teachers
             students = students.filter(
-                Q(name__icontains=search_query)
+                Q(name_search__contains=search_key)
             )
     
     context = {
@@ -566,48 +414,18 @@ def student_list(request):
 
 @login_required
 def student_detail(request, student_id):
-    # Get user profile
-    try:
-        user_profile = request.user.userprofile
-    except UserProfile.DoesNotExist:
-        # Check if this is a student user account (created by the StudentPhoneBackend)
-        if request.user.username.startswith('student_'):
-            # This is a student user account
-            # Determine if it's a parent (multiple students with same phone) or student
-            try:
-                student = Student.objects.get(id=int(request.user.username.split('_')[1]))
-                # Count how many students share this phone number
-                phone_number = student.phone_number
-                if phone_number:
-                    student_count = Student.objects.filter(phone_number=phone_number, is_active=True).count()
-                    role = 'parent' if student_count > 1 else 'student'
-                else:
-                    role = 'student'
-                user_profile = UserProfile.objects.create(user=request.user, role=role, student=student)
-            except (ValueError, Student.DoesNotExist):
-                # Fallback to student role if we can't determine
-                user_profile = UserProfile.objects.create(user=request.user, role='student')
-        # But don't assume it's a teacher - let's check if it's linked to a student
-        elif hasattr(request.user, 'student_set') and request.user.student_set.exists():
-            # This user is linked to a student, so they should be a student or parent
-            student_count = request.user.student_set.count()
-            role = 'parent' if student_count > 1 else 'student'
-            user_profile = UserProfile.objects.create(user=request.user, role=role)
-        else:
-            # Default to teacher for staff/admin users
-            user_profile = UserProfile.objects.create(user=request.user, role='teacher')
+    role = request.iq_role
     
     # Role-based access
-    if user_profile.role == 'student':
+    if role == 'student':
         # Students can only see their own details
-        if user_profile.student and user_profile.student.id == student_id:
-            student = get_object_or_404(Student, id=student_id)
-        else:
+        student = request.iq_students.filter(id=student_id).first()
+        if student is None:
             return HttpResponseForbidden("You don't have permission to view this student's details.")
-    elif user_profile.role == 'teacher':
+    elif role == 'teacher':
         # Teachers can only see their own students
         student = get_object_or_404(Student, id=student_id, teacher=request.user)
-    elif user_profile.role == 'admin':
+    elif role == 'admin':
         # Admins can see all students
         student = get_object_or_404(Student, id=student_id)
     else:
@@ -626,7 +444,7 @@ def student_detail(request, student_id):
 @login_required
 def student_create(request):
     if request.method == 'POST':
-        form = StudentForm(request.POST, user=request.user)
+        form = StudentForm(request.POST, user=request.user, role=request.iq_role)
         if form.is_valid():
             student = form.save()
             
@@ -654,58 +472,29 @@ def student_create(request):
             messages.success(request, f'Student "{student.name}" has been created successfully.')
             return redirect('student_list')
     else:
-        form = StudentForm(user=request.user)
+        form = StudentForm(user=request.user, role=request.iq_role)
     
     return render(request, 'student_create.html', {'form': form})
 
 @login_required
 def student_edit(request, student_id):
-    # Get user profile to check permissions
-    try:
-        user_profile = request.user.userprofile
-    except UserProfile.DoesNotExist:
-        # Check if this is a student user account (created by the StudentPhoneBackend)
-        if request.user.username.startswith('student_'):
-            # This is a student user account
-            # Determine if it's a parent (multiple students with same phone) or student
-            try:
-                student = Student.objects.get(id=int(request.user.username.split('_')[1]))
-                # Count how many students share this phone number
-                phone_number = student.phone_number
-                if phone_number:
-                    student_count = Student.objects.filter(phone_number=phone_number, is_active=True).count()
-                    role = 'parent' if student_count > 1 else 'student'
-                else:
-                    role = 'student'
-                user_profile = UserProfile.objects.create(user=request.user, role=role, student=student)
-            except (ValueError, Student.DoesNotExist):
-                # Fallback to student role if we can't determine
-                user_profile = UserProfile.objects.create(user=request.user, role='student')
-        # But don't assume it's a teacher - let's check if it's linked to a student
-        elif hasattr(request.user, 'student_set') and request.user.student_set.exists():
-            # This user is linked to a student, so they should be a student or parent
-            student_count = request.user.student_set.count()
-            role = 'parent' if student_count > 1 else 'student'
-            user_profile = UserProfile.objects.create(user=request.user, role=role)
-        else:
-            # Default to teacher for staff/admin users
-            user_profile = UserProfile.objects.create(user=request.user, role='teacher')
+    role = request.iq_role
     
     # Role-based access
-    if user_profile.role == 'admin':
+    if role == 'admin':
         student = get_object_or_404(Student, id=student_id)
-    elif user_profile.role == 'teacher':
+    elif role == 'teacher':
         student = get_object_or_404(Student, id=student_id, teacher=request.user)
     else:
         return HttpResponseForbidden("You don't have permission to edit students.")
     
     if request.method == 'POST':
-        form = StudentEditForm(request.POST, instance=student, user=request.user)
+        # Remember the stored values: validating the form overwrites them on student
+        old_balance = student.balance
+        old_teacher = student.teacher
+        old_phone = student.phone_number
+        form = StudentEditForm(request.POST, instance=student, user=request.user, role=request.iq_role)
         if form.is_valid():
-            old_balance = student.balance
-            old_teacher = student.teacher
-            old_phone = student.phone_number
-            
             updated_student = form.save()
             new_balance = updated_student.balance
             new_teacher = updated_student.teacher
@@ -735,13 +524,17 @@ def student_edit(request, student_id):
             if old_balance != new_balance:
                 balance_difference = new_balance - old_balance
                 transaction_type = 'AWARD' if balance_difference > 0 else 'DEDUCT'
-                Transaction.objects.create(
+                trans = Transaction.objects.create(
                     type=transaction_type,
                     amount=abs(balance_difference),
                     student=updated_student,
                     teacher=request.user,
                     comment=f'Balance manually adjusted from {old_balance} to {new_balance}'
                 )
+                analytics.record_transactions([trans])
+                # Manual awards count as coins earned, like any other award
+                if transaction_type == 'AWARD':
+                    leaderboards.record([updated_student], 0, earned=trans.amount, when=trans.date)
             
             # If teacher was changed, add a comment about the transfer
             if old_teacher != new_teacher:
@@ -750,10 +543,98 @@ def student_edit(request, student_id):
             messages.success(request, f'Student "{updated_student.name}" has been updated successfully.')
             return redirect('student_detail', student_id=updated_student.id)
     else:
-        form = StudentEditForm(instance=student, user=request.user)
+        form = StudentEditForm(instance=student, user=request.user, role=request.iq_role)
     
     context = {
         'form': form,
         'student': student,
     }
-    return render(request, 'student_edit.html', context)
\ No newline at end of file
+    return render(request, 'student_edit.html', context)
+
+
+LEADERBOARD_TITLES = {
+    'balance': 'Баланс',
+    'week': 'Заработано за неделю',
+    'month': 'Заработано за месяц',
+}
+
+@login_required
+def leaderboard(request):
+    role = request.iq_role
+    metric = request.GET.get('metric')
+    if metric not in leaderboards.METRICS:
+        metric = 'balance'
+    
+    # Teachers look at their own students unless they ask for the whole school;
+    # admins can pick any teacher; students and parents see the whole school
+    teacher_id = None
+    if role == 'teacher' and request.GET.get('scope') != 'school':
+        teacher_id = request.user.id
+    elif role == 'admin' and request.GET.get('teacher', '').isdigit():
+        teacher_id = int(request.GET['teacher'])
+    
+    top = leaderboards.top(metric, teacher_id)
+    # Names of the listed students in one query
+    names = Student.objects.filter(id__in=[student_id for student_id, _ in top]).in_bulk()
+    entries = [
+        {
+            'rank': leaderboards.rank(metric, student_id, teacher_id)[0],
+            'student': names[student_id],
+            'score': score,
+        }
+        for student_id, score in top
+        if student_id in names
+    ]
+    
+    # Students and parents also see where each of their own students stands
+    my_ranks = []
+    if role in ['student', 'parent'] and request.iq_household:
+        for student in request.iq_household['students']:
+            my_ranks.append({
+                'student': student,
+                'school_rank': leaderboards.rank(metric, student.id),
+                'school_size': leaderboards.board_size(metric),
+                'teacher_rank': leaderboards.rank(metric, student.id, student.teacher_id),
+                'teacher_size': leaderboards.board_size(metric, student.teacher_id),
+            })
+    
+    context = {
+        'entries': entries,
+        'my_ranks': my_ranks,
+        'metric': metric,
+        'metrics': LEADERBOARD_TITLES,
+        'title': LEADERBOARD_TITLES[metric],
+        'scope': 'teacher' if teacher_id else 'school',
+        # Keeps the chosen scope when switching between metrics
+        'scope_query': f'&teacher={teacher_id}' if role == 'admin' and teacher_id else (
+            '&scope=school' if role == 'teacher' and not teacher_id else ''
+        ),
+    }
+    return render(request, 'leaderboard.html', context)
+
+@admin_required
+def analytics_view(request):
+    """
+    Award and deduction totals per teacher and per week for a date range,
+    read from the daily rollup (default: the last 12 weeks).
+    """
+    # parse_date raises ValueError for well-formed but impossible dates (2024-02-30)
+    try:
+        end = parse_date(request.GET.get('end') or '')
+    except ValueError:
+        end = None
+    end = end or timezone.localdate()
+    try:
+        start = parse_date(request.GET.get('start') or '')
+    except ValueError:
+        start = None
+    start = start or end - timedelta(weeks=12)
+    if start > end:
+        start, end = end, start
+    
+    context = analytics.summary(start, end)
+    context.update({
+        'start': start,
+        'end': end,
+    })
+    return render(request, 'analytics.html', context)
@@ -9,7 +9,8 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 SECRET_KEY = config('SECRET_KEY')
 
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = True
+# Set DEBUG=False in the environment there (DEBUG also keeps every SQL query in memory)
+DEBUG = config('DEBUG', default=True, cast=bool)
 
 # Update this to include your PythonAnywhere hostname
 ALLOWED_HOSTS = ['localhost', '127.0.0.1', '[::1]', '.pythonanywhere.com']
@@ -25,11 +26,14 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so its timings cover the rest of the stack; inactive unless REQUEST_TIMING is set
+    'iqcoin_app.middleware.RequestTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'iqcoin_app.middleware.RoleMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -63,6 +67,58 @@ DATABASES = {
     }
 }
 
+# Cache configuration
+# CACHE_BACKEND selects where cached data lives:
+#   file      - files under CACHE_LOCATION, shared by all processes on one host (default)
+#   redis     - a Redis server at CACHE_LOCATION (needs the redis package)
+#   memcached - a Memcached server at CACHE_LOCATION (needs the pymemcache package)
+#   locmem    - in process memory; only for a single process (development, tests)
+# Role, household, leaderboard, API ETag, student lookup and teacher-name
+# invalidation all go through the cache, so every worker process must share
+# it: with locmem, a change made in one worker is never seen by the others.
+CACHE_BACKENDS = {
+    'locmem': ('django.core.cache.backends.locmem.LocMemCache', 'iqcoin'),
+    'file': ('django.core.cache.backends.filebased.FileBasedCache', str(BASE_DIR / 'cache')),
+    'redis': ('django.core.cache.backends.redis.RedisCache', 'redis://127.0.0.1:6379'),
+    'memcached': ('django.core.cache.backends.memcached.PyMemcacheCache', '127.0.0.1:11211'),
+}
+CACHE_BACKEND = config('CACHE_BACKEND', default='file')
+if CACHE_BACKEND not in CACHE_BACKENDS:
+    raise ValueError(f"CACHE_BACKEND must be one of: {', '.join(CACHE_BACKENDS)}")
+
+CACHES = {
+    'default': {
+        'BACKEND': CACHE_BACKENDS[CACHE_BACKEND][0],
+        'LOCATION': config('CACHE_LOCATION', default=CACHE_BACKENDS[CACHE_BACKEND][1]),
+        'KEY_PREFIX': config('CACHE_KEY_PREFIX', default='iqcoin'),
+    }
+}
+
+# Session storage
+# SESSION_MODE selects how sessions are stored:
+#   cached_db      - read from the cache, written through to the database
+#                    (default with a shared CACHE_BACKEND)
+#   cache          - cache only (sessions are lost if the cache is cleared)
+#   signed_cookies - in the browser cookie, signed with SECRET_KEY; no server storage
+#   db             - database only (default with CACHE_BACKEND=locmem)
+# The cache modes need a shared cache: with locmem a logout in one worker
+# would leave the session alive in the others.
+# Expired sessions left in the database are removed with Django's
+# clearsessions management command (run it daily, e.g. from cron).
+SESSION_ENGINES = {
+    'cached_db': 'django.contrib.sessions.backends.cached_db',
+    'cache': 'django.contrib.sessions.backends.cache',
+    'signed_cookies': 'django.contrib.sessions.backends.signed_cookies',
+    'db': 'django.contrib.sessions.backends.db',
+}
+SESSION_MODE = config('SESSION_MODE', default='db' if CACHE_BACKEND == 'locmem' else 'cached_db')
+if SESSION_MODE not in SESSION_ENGINES:
+    raise ValueError(f"SESSION_MODE must be one of: {', '.join(SESSION_ENGINES)}")
+if SESSION_MODE in ('cache', 'cached_db') and CACHE_BACKEND == 'locmem':
+    raise ValueError(f"SESSION_MODE={SESSION_MODE} needs a shared CACHE_BACKEND (file, redis or memcached), not locmem")
+SESSION_ENGINE = SESSION_ENGINES[SESSION_MODE]
+SESSION_COOKIE_AGE = config('SESSION_COOKIE_AGE', default=1209600, cast=int)  # 2 weeks
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -99,6 +155,12 @@ STATICFILES_DIRS = [
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Number of transactions shown per page of the transaction history
+TRANSACTION_HISTORY_PAGE_SIZE = config('TRANSACTION_HISTORY_PAGE_SIZE', default=50, cast=int)
+# Students per page of the history's student filter; larger rosters are
+# loaded page by page as the user searches instead of rendered inline
+STUDENT_FILTER_PAGE_SIZE = config('STUDENT_FILTER_PAGE_SIZE', default=100, cast=int)
+
 LOGIN_URL = '/login/'
 LOGIN_REDIRECT_URL = '/'
 LOGOUT_REDIRECT_URL = '/login/'
@@ -114,6 +176,14 @@ CSRF_TRUSTED_ORIGINS = [
     'http://127.0.0.1:8000',
 ]
 
+# Per-request instrumentation (RequestTimingMiddleware): view, role, wall
+# time and SQL queries of every request, as a Server-Timing header and one
+# JSON log line on the 'iqcoin_app.requests' logger. Requests over either
+# threshold are logged as warnings.
+REQUEST_TIMING = config('REQUEST_TIMING', default=False, cast=bool)
+REQUEST_TIMING_MAX_QUERIES = config('REQUEST_TIMING_MAX_QUERIES', default=50, cast=int)
+REQUEST_TIMING_MAX_MS = config('REQUEST_TIMING_MAX_MS', default=300, cast=int)
+
 # Logging configuration
 LOGGING = {
     'version': 1,